@@ -1,8 +1,8 @@
 from lib.Settings import Settings
 from lib.SonarData import SonarData
 from lib.Georef import Georef
-from lib.io import FileNaming
-from lib.GausKruger import GausKruger
+from lib.io import FileNaming, npToCsv, saveTrack, WGS_CSV_FORMAT, PLANE_CSV_FORMAT
+from lib.Projection import Projection
 import os
 from tkinter.filedialog import askdirectory
 import glob
@@ -25,31 +25,22 @@ if __name__ == '__main__':
     print(xtf_list)
 
     # Process data
+    times_list = []
+    tracks = []
     for xtf_file in xtf_list:
         naming = FileNaming(xtf_file)
-        # track_file = '.'.join(xtf_file.split('.')[:-1]) + '.csv'
-        # georef = track_file + '.gsr2'
-        track_file = naming.get_track_WGS_name()
-        track_GK_file = naming.get_track_GK_name()
-        georef = naming.get_track_georef_name()
-
-        sonar_data = SonarData(xtf_file)
-        track = sonar_data.extractTrackWGS84()
-        with open(track_file, 'w') as wfile:
-            for line in track:
-                wfile.write(f'{line[0]};{line[1]}\n')
-        print(f'Writing file {track_file} done')
-        gr = Georef()
-        gr.makeSurferGeorefWGS84(georef)
-
-        # Gauss Kruger
-        GK = GausKruger()
-        with open(track_GK_file, 'w') as wfile:
-            lon = track[:,0]
-            lat = track[:,1]
-            GK_X, GK_Y, zone = GK.transform_to_gauss_kruger(lat, lon, 12)
-            for x, y in zip(GK_X, GK_Y):
-                wfile.write(f'{x};{y}\n')
-        print(f'Writing file {track_file} done')
-
-    
\ No newline at end of file
+        sonar_data = SonarData(xtf_file, naming.get_index_name(), channels=settings.channels)
+        times_list.append(sonar_data.extractPingTimes())
+        tracks.append(sonar_data.extractTrackWGS84())
+
+    # All tracks in one projection
+    projection = Projection.forSurvey(settings.projection, tracks)
+    print(f'Tracks are projected to {projection}')
+    for xtf_file, times, track, track_xy in zip(xtf_list, times_list, tracks, projection.projectTracks(tracks)):
+        naming = FileNaming(xtf_file)
+        saveTrack(naming.get_track_name(), times, track, track_xy, projection.crs)
+        # CSV files for Surfer are always written by this script
+        npToCsv(naming.get_track_WGS_name(), track, WGS_CSV_FORMAT)
+        Georef().makeSurferGeorefWGS84(naming.get_track_georef_name())
+        npToCsv(naming.get_track_GK_name(), track_xy, PLANE_CSV_FORMAT)
+
@@ -49,7 +49,7 @@ if __name__ == '__main__':
 
         try:
             track_input = loadCsvGK(track_GK_file)
-            sonar = SonarData(xtf_file)
+            sonar = SonarData(xtf_file, naming.get_index_name())
         except FileNotFoundError:
             print('Missed files')
             exit(1)
@@ -0,0 +1,100 @@
+"""
+Module to estimate first reflection (bottom) for many pings at once.
+Input is 2D array of one channel, each row is one ping.
+"""
+
+import numpy as np
+from scipy.signal import medfilt2d
+from lib.Parallel import SharedArray
+
+MEDIAN_WINDOW = 11
+TAIL_CUT = 10 # Last samples are removed, because yellowfin has strange drop of data there
+
+
+def stepResponse(rows, window_size):
+    """
+    Convolve each row with step function from 1 to -1 with step in the center of window.
+    Convolution is calculated as difference of two box sums over cumulative sum.
+    Values closer than half window to the edges are zero.
+    """
+    if window_size % 2 == 0:
+        raise ValueError
+    half_window = (window_size-1)//2
+    length = rows.shape[1]
+    output = np.zeros(rows.shape)
+    if length < window_size:
+        return output
+
+    csum = np.zeros((rows.shape[0], length + 1))
+    np.cumsum(rows, axis=1, out=csum[:, 1:])
+    # For center c: sum(rows[c+1 : c+half+1]) - sum(rows[c-half : c+1])
+    far = csum[:, window_size:]
+    center = csum[:, half_window + 1 : length - half_window + 1]
+    near = csum[:, : length - 2*half_window]
+    output[:, half_window : length - half_window] = (far - center) - (center - near)
+    return output
+
+
+def bottomResponse(rgt_rows, start_refl, window_size):
+    """
+    Log signal after start_refl pixel, median filtered and convolved with step function
+    """
+    rgt_log = np.log(rgt_rows[:, start_refl:] + 0.001).astype(np.float32)[:, :-TAIL_CUT]
+    rgt_fltrd = medfilt2d(rgt_log, (1, MEDIAN_WINDOW))
+    return stepResponse(rgt_fltrd, window_size)
+
+
+def detectFirstReflections(rgt_rows, start_refl, window_size, frst_refl_bias):
+    """
+    Returns array of first reflection indices and mask of pings
+    where first reflection was found
+    """
+    if rgt_rows.shape[1] - start_refl - TAIL_CUT < window_size:
+        # Signal is too short to search bottom
+        return np.zeros(rgt_rows.shape[0], dtype=int), np.zeros(rgt_rows.shape[0], dtype=bool)
+
+    rgt_proc = bottomResponse(rgt_rows, start_refl, window_size)
+    valid = ~np.isnan(rgt_proc).any(axis=1)
+    first_refl = np.argmax(rgt_proc, axis=1) + start_refl + frst_refl_bias
+    return first_refl, valid
+
+
+def detectFirstReflectionsGrouped(rgt_rows, lengths, start_refl, window_size, frst_refl_bias):
+    """
+    detectFirstReflections for pings of different length (rows padded at the end)
+    and different start of search. Pings with equal length and start are processed together
+    """
+    first_refl = np.zeros(len(lengths), dtype=int)
+    valid = np.zeros(len(lengths), dtype=bool)
+    groups, group_of_ping = np.unique(np.column_stack((lengths, start_refl)),
+                                      axis=0, return_inverse=True)
+    group_of_ping = group_of_ping.ravel()
+    pings_by_group = np.split(np.argsort(group_of_ping, kind='stable'),
+                              np.cumsum(np.bincount(group_of_ping))[:-1])
+    for (length, start_px), group_pings in zip(groups, pings_by_group):
+        first_refl[group_pings], valid[group_pings] = \
+            detectFirstReflections(rgt_rows[group_pings, :length], int(start_px),
+                                   window_size, frst_refl_bias)
+    return first_refl, valid
+
+
+def detectFirstReflectionsShared(rgt_descriptor, first_ping, lengths, start_refl, window_size, frst_refl_bias):
+    """
+    Worker process function: detect first reflections for chunk of pings
+    starting from first_ping in shared right channel array
+    """
+    rgt = SharedArray.attach(rgt_descriptor)
+    try:
+        rgt_rows = rgt.array[first_ping : first_ping + len(lengths)]
+        return detectFirstReflectionsGrouped(rgt_rows, lengths, start_refl, window_size, frst_refl_bias)
+    finally:
+        rgt_rows = None
+        rgt.close()
+
+
+def fillFromPrevious(values, valid, initial=0):
+    """
+    Replace values where not valid with last valid value before them
+    """
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(values)), -1))
+    return np.where(last_valid >= 0, values[np.maximum(last_valid, 0)], initial)
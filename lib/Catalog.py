@@ -0,0 +1,158 @@
+"""
+Module to build catalog of XTF files of survey directory without reading sonar samples.
+Catalog is JSON file in proc folder with ping count, time span, bounding boxes
+and channel layout of every file. Files not changed since last scan are not read again.
+"""
+
+import os
+import glob
+import json
+import numpy as np
+import pyxtf
+import lib.Utils as ut
+from lib.io import FileNaming, saveJson
+from lib.XTFReader import XTFReader
+from lib.Projection import Projection
+from concurrent.futures import ProcessPoolExecutor
+
+CATALOG_NAME = 'catalog.json'
+# Change when catalog entries change, so old catalogs are rebuilt
+CATALOG_VERSION = 3
+
+
+def catalogName(directory):
+    return os.path.join(directory, FileNaming.proc_name, CATALOG_NAME)
+
+
+def epochToText(seconds):
+    return str(np.datetime64(int(seconds), 's')).replace('T', ' ')
+
+
+def boundingBox(x, y):
+    """
+    [min x, min y, max x, max y]
+    """
+    return [float(np.min(x)), float(np.min(y)), float(np.max(x)), float(np.max(y))]
+
+
+def scanXtf(xtf_file):
+    """
+    Catalog entry of one XTF file, only packet, ping and channel headers are read.
+    Packet index is created in proc folder as in mosaic run
+    """
+    stat = os.stat(xtf_file)
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    try:
+        reader = XTFReader(xtf_file, FileNaming(xtf_file).get_index_name())
+    except (OSError, ValueError) as e:
+        entry['error'] = str(e)
+        return entry
+
+    headers = reader.ping_headers
+    times = ut.timeToEpoch(headers['Year'],
+                           headers['Month'] + 1, # Month in XTF starts from 0
+                           headers['Day'],
+                           headers['Hour'],
+                           headers['Minute'],
+                           headers['Second'],
+                           headers['HSeconds']) + reader.day_offsets * 86400.0
+    duration = float(times[-1] - times[0])
+    entry.update({'pings': int(reader.pings_num),
+                  'start_time': epochToText(times[0]),
+                  'end_time': epochToText(times[-1]),
+                  'duration': duration,
+                  'pings_per_sec': reader.pings_num / duration if duration > 0 else None,
+                  'samples': reader.num_samples.max(axis=0).tolist(),
+                  'slant_range': reader.chan_headers['SlantRange'].max(axis=0).astype(float).tolist(),
+                  'channels': [channelLayout(number, chan_info)
+                               for number, chan_info in enumerate(reader.file_header.sonar_info)]})
+
+    lon = headers['ShipXcoordinate'].astype(np.float64)
+    lat = headers['ShipYcoordinate'].astype(np.float64)
+    # Pings without navigation have zero coordinates
+    valid = np.isfinite(lon) & np.isfinite(lat) & ((lon != 0) | (lat != 0))
+    if valid.any():
+        lon, lat = lon[valid], lat[valid]
+        projection = Projection.forSurvey('GK', [np.column_stack((lon, lat))])
+        GK_X, GK_Y = projection.project(lon, lat)
+        entry.update({'bbox_wgs84': boundingBox(lon, lat),
+                      'gk_crs': projection.crs,
+                      'bbox_gk': boundingBox(GK_X, GK_Y)})
+    return entry
+
+
+def channelLayout(number, chan_info):
+    try:
+        channel_type = pyxtf.XTFChannelType(chan_info.TypeOfChannel).name
+    except ValueError:
+        channel_type = str(chan_info.TypeOfChannel)
+    return {'channel': number,
+            'type': channel_type,
+            'sub_channel': int(chan_info.SubChannelNumber),
+            'frequency': float(chan_info.Frequency),
+            'bytes_per_sample': int(chan_info.BytesPerSample)}
+
+
+def loadCatalog(directory):
+    """
+    Catalog of directory, empty if it wasn't built or is of other version
+    """
+    try:
+        with open(catalogName(directory), 'r') as f_read:
+            catalog = json.load(f_read)
+    except (OSError, ValueError):
+        return {'version': CATALOG_VERSION, 'files': {}}
+    if catalog.get('version') != CATALOG_VERSION or not isinstance(catalog.get('files'), dict):
+        return {'version': CATALOG_VERSION, 'files': {}}
+    return catalog
+
+
+def updateCatalog(directory, workers=0, status=print, aborted=lambda: False):
+    """
+    Scan new and changed XTF files of directory (by size and modification time)
+    in worker processes and write catalog. workers is number of processes, 0 for all CPU cores.
+    aborted is checked between files, if it returns True scan stops and catalog is not written.
+    Returns catalog, entries of removed files are dropped, or None if scan was aborted
+    """
+    xtf_list = sorted(glob.glob(os.path.join(directory, '*.xtf')))
+    old_files = loadCatalog(directory)['files']
+    files = {}
+    to_scan = []
+    for xtf_file in xtf_list:
+        name = os.path.basename(xtf_file)
+        stat = os.stat(xtf_file)
+        entry = old_files.get(name)
+        if entry is not None and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            files[name] = entry
+        else:
+            to_scan.append(xtf_file)
+    status(f'{len(xtf_list)} XTF files, {len(to_scan)} new or changed')
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(to_scan))
+    entries = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(scanXtf, xtf_file) for xtf_file in to_scan]
+            for future in futures:
+                if aborted():
+                    # Files being scanned are finished, the rest are not started
+                    pool.shutdown(cancel_futures=True)
+                    return None
+                entries.append(future.result())
+    else:
+        for xtf_file in to_scan:
+            if aborted():
+                return None
+            entries.append(scanXtf(xtf_file))
+    for xtf_file, entry in zip(to_scan, entries):
+        files[os.path.basename(xtf_file)] = entry
+        if 'error' in entry:
+            status(f'{xtf_file}: {entry["error"]}')
+
+    catalog = {'version': CATALOG_VERSION, 'files': dict(sorted(files.items()))}
+    # FileNaming creates proc folder, but there may be no XTF files
+    os.makedirs(os.path.dirname(catalogName(directory)), exist_ok=True)
+    saveJson(catalogName(directory), catalog)
+    return catalog
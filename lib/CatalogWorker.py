@@ -0,0 +1,44 @@
+from PySide6.QtCore import QObject, Signal, Slot
+import traceback
+from lib.Settings import Settings
+from lib.Catalog import updateCatalog, catalogName
+
+
+class CatalogWorker(QObject):
+    status = Signal(str)
+    finished = Signal()
+    cancelled = Signal()
+
+    def __init__(self, settings : Settings):
+        super().__init__()
+        self._abort = False
+        self.settings = settings
+
+    def abort(self):
+        self._abort = True
+
+    def process(self):
+        self._abort = False
+        try:
+            if self._process():
+                self.finished.emit()
+            else:
+                self.cancelled.emit()
+        except BaseException as e:
+            self.status.emit(f"An exception occurred: {e}\nException type: {type(e).__name__}")
+            traceback.print_exc()
+            self.cancelled.emit()
+
+    @Slot(str)
+    def _process(self):
+        catalog = updateCatalog(self.settings.directory, self.settings.workers, self.status.emit,
+                                lambda: self._abort)
+        if catalog is None:
+            self.status.emit('Scan cancelled, catalog is not changed')
+            return False
+        entries = [entry for entry in catalog['files'].values() if 'error' not in entry]
+        pings = sum(entry['pings'] for entry in entries)
+        hours = sum(entry['duration'] for entry in entries) / 3600
+        self.status.emit(f'Catalog of {len(catalog["files"])} files: {pings} pings, {hours:.1f} hours\n'
+                         f'Saved to {catalogName(self.settings.directory)}')
+        return True
@@ -37,6 +37,8 @@ class MosaicGUI(QWidget):
 
         self.open_btn = QPushButton("Open Folder")
         self.convert_btn = QPushButton("Convert RASTR to XTF")
+        self.catalog_btn = QPushButton("Scan Survey")
+        self.catalog_btn.setToolTip("Write catalog of XTF files to proc folder, sonar data is not read")
         self.open_btn.clicked.connect(self._open_folder)
         self.convert_btn.clicked.connect(self._convert_rastr)
 
@@ -61,6 +63,7 @@ class MosaicGUI(QWidget):
         top_btn_layout = QHBoxLayout()
         top_btn_layout.addWidget(self.open_btn)
         top_btn_layout.addWidget(self.convert_btn)
+        top_btn_layout.addWidget(self.catalog_btn)
 
         # left_layout
         # left_layout.addWidget(self.convert_btn)
@@ -103,9 +106,20 @@ class MosaicGUI(QWidget):
         self.stripescale_edit = QLineEdit()
         self.corsltrg_searchwindow_edit = QLineEdit()
         self.corcltrg_frst_refl_bias_edit = QLineEdit()
+        self.workers_edit = QLineEdit()
+        self.channels_edit = QLineEdit()
+        self.start_time_edit = QLineEdit()
+        self.end_time_edit = QLineEdit()
+        self.cache_size_edit = QLineEdit()
+        self.projection_edit = QLineEdit()
+        self.canvas_edit = QLineEdit()
+        self.tile_memory_edit = QLineEdit()
+        self.colormap_edit = QLineEdit()
+        self.renderer_edit = QLineEdit()
 
         self.debug_check = QCheckBox()
         self.correct_slantrange_check = QCheckBox()
+        self.export_csv_check = QCheckBox()
 
         self._add_setting("Directory:", self.directory_edit, "Path to data directory")
         self._add_setting("Map Scale (px/m):", self.mapscale_edit, "Resulting scale in Pixels per meter")
@@ -119,6 +133,17 @@ class MosaicGUI(QWidget):
         self._add_setting("Start Bottom Search (m):", self.startsearchbottom_edit, "Start searching bottom from this value")
         self._add_setting("Convolution Window (px):", self.corsltrg_searchwindow_edit, "Window used to detect first reflection")
         self._add_setting("First Reflection Shift (px):", self.corcltrg_frst_refl_bias_edit, "Shift first reflection to avoid black stripe in the middle, pixels")
+        self._add_setting("Worker Processes:", self.workers_edit, "Number of processes for slant range correction, 0 - all CPU cores")
+        self._add_setting("Sonar Channels:", self.channels_edit, "Port and starboard channel numbers in XTF, e.g. 0,1 or 2,3 for second frequency")
+        self._add_setting("Start Time (HH:MM:SS):", self.start_time_edit, "Process pings from this time (UTC as in XTF), empty - from the beginning of file")
+        self._add_setting("End Time (HH:MM:SS):", self.end_time_edit, "Process pings up to this time (UTC as in XTF), empty - to the end of file")
+        self._add_setting("Cache Size (MB):", self.cache_size_edit, "Size limit of intermediate results kept in proc folder for faster reruns, 0 - no cache")
+        self._add_setting("Projection:", self.projection_edit, "GK or UTM - zone chosen for all files of folder, or coordinate system like EPSG:32637")
+        self._add_setting("Canvas:", self.canvas_edit, "tiled - memory only for area covered by sonar data, dense - one image over the whole line, disk - tiles on disk for very large mosaics")
+        self._add_setting("Tile Memory (MB):", self.tile_memory_edit, "Memory for mosaic tiles of disk canvas, other tiles are kept on disk")
+        self._add_setting("Colormap:", self.colormap_edit, "Matplotlib colormap for RGB mosaic, e.g. copper, empty - grayscale mosaic")
+        self._add_setting("Renderer:", self.renderer_edit, "stripes - rotated stripes, inverse - every map pixel is sampled from nearest ping, without gaps between stripes")
+        self._add_setting("Export CSV Tracks:", self.export_csv_check, "Also write tracks to CSV files for Surfer")
         # self._add_setting("Debug:", self.debug_check, "Enable debug output")
 
         self.apply_btn = QPushButton("Apply")
@@ -173,6 +198,7 @@ class MosaicGUI(QWidget):
     def set_running(self, running: bool):
         self.start_btn.setEnabled(not running)
         self.convert_btn.setEnabled(not running)
+        self.catalog_btn.setEnabled(not running)
         self.cancel_btn.setEnabled(running)
 
 
@@ -189,9 +215,20 @@ class MosaicGUI(QWidget):
         self.stripescale_edit.setText(str(settings.get("stripescale", "")))
         self.corsltrg_searchwindow_edit.setText(str(settings.get("corsltrg_searchwindow", "")))
         self.corcltrg_frst_refl_bias_edit.setText(str(settings.get("corcltrg_frst_refl_bias", "")))
+        self.workers_edit.setText(str(settings.get("workers", "")))
+        self.channels_edit.setText(str(settings.get("channels", "")))
+        self.start_time_edit.setText(str(settings.get("start_time", "")))
+        self.end_time_edit.setText(str(settings.get("end_time", "")))
+        self.cache_size_edit.setText(str(settings.get("cache_size", "")))
+        self.projection_edit.setText(str(settings.get("projection", "")))
+        self.canvas_edit.setText(str(settings.get("canvas", "")))
+        self.tile_memory_edit.setText(str(settings.get("tile_memory", "")))
+        self.colormap_edit.setText(str(settings.get("colormap", "")))
+        self.renderer_edit.setText(str(settings.get("renderer", "")))
 
         # self.debug_check.setChecked(bool(int(settings.get("debug", 0))))
         self.correct_slantrange_check.setChecked(bool(int(settings.get("correct_slantrange", 0))))
+        self.export_csv_check.setChecked(bool(int(settings.get("export_csv", 0))))
 
     def get_settings(self) -> dict:
         return {
@@ -209,7 +246,18 @@ class MosaicGUI(QWidget):
             "debug" : 0,
             "correct_slantrange": int(self.correct_slantrange_check.isChecked()),
             "corsltrg_searchwindow": int(self.corsltrg_searchwindow_edit.text()),
-            "corcltrg_frst_refl_bias": int(self.corcltrg_frst_refl_bias_edit.text())
+            "corcltrg_frst_refl_bias": int(self.corcltrg_frst_refl_bias_edit.text()),
+            "workers": int(self.workers_edit.text()),
+            "channels": self.channels_edit.text(),
+            "start_time": self.start_time_edit.text(),
+            "end_time": self.end_time_edit.text(),
+            "cache_size": int(self.cache_size_edit.text()),
+            "projection": self.projection_edit.text(),
+            "export_csv": int(self.export_csv_check.isChecked()),
+            "canvas": self.canvas_edit.text(),
+            "tile_memory": int(self.tile_memory_edit.text()),
+            "colormap": self.colormap_edit.text(),
+            "renderer": self.renderer_edit.text()
         }
 
     def set_preview_image(self, image):
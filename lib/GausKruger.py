@@ -1,4 +1,4 @@
-from pyproj import Transformer
+from lib.Projection import WGS84, GK_EPSG_BASE, getTransformer, gaussKrugerZone
 
 class GausKruger:
 
@@ -7,20 +7,20 @@ class GausKruger:
 
     def gauss_kruger_zone(self, longitude):
         """Determine the Gauss-Kruger zone based on longitude."""
-        return int((longitude + 6) / 6)
+        return gaussKrugerZone(longitude)
 
     def transform_to_gauss_kruger(self, latitude, longitude, zone=None):
         """Transform geographical coordinates to Gauss-Kruger (Pulkovo) projection."""
         if zone is None:
             zone = self.gauss_kruger_zone(longitude[0])
         # Define the EPSG code for the Gauss-Kruger zone
-        epsg_code = 28400 + zone
-        # Create a transformer object
-        transformer = Transformer.from_crs("EPSG:4326", f"EPSG:{epsg_code}", always_xy=True)
+        epsg_code = GK_EPSG_BASE + zone
+        # Transformer is created once for every zone (see Projection module)
+        transformer = getTransformer(WGS84, f"EPSG:{epsg_code}")
         # Perform the transformation
         x, y = transformer.transform(longitude, latitude)
         return x, y, zone
-    
+
 
 
 # x, y, zone = transform_to_gauss_kruger(latitude, longitude)
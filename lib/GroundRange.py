@@ -0,0 +1,103 @@
+"""
+Module to resample sonar waterfall from slant range to ground range.
+Every ping is remapped with its own fish height (first reflection),
+all output pings have the same ground range and number of pixels.
+"""
+
+import cv2
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+# Pings with less samples after first reflection are left in slant range
+MIN_CORRECTED_SAMPLES = 100
+# cv2.remap works with images smaller than 32767 px on each side, so waterfall is remapped
+# by blocks of pings and by blocks of output columns
+REMAP_BLOCK_PINGS = 4096
+REMAP_MAX_SIZE = 32000
+# Map value for pixels beyond the end of ping
+OUTSIDE = -2.0
+
+
+def fishHeights(lengths, slant_ranges, first_refl):
+    """
+    Fish height in meters for every ping.
+    Zero for pings that are too short after first reflection
+    """
+    heights = slant_ranges * first_refl / lengths
+    return np.where(lengths - first_refl > MIN_CORRECTED_SAMPLES, heights, 0.0)
+
+
+def groundRanges(lengths, slant_ranges, heights):
+    """
+    Ground range of the last sample of every ping, meters
+    """
+    last_range = slant_ranges * (lengths - 1) / lengths
+    return np.sqrt(np.maximum(last_range*last_range - heights*heights, 0))
+
+
+def imageGroundRange(lengths, slant_ranges, heights):
+    """
+    Ground range of output image, meters: the largest ground range of corrected pings.
+    Pings left in slant range are usually outliers, they are used only if there are no others
+    """
+    ground_ranges = groundRanges(lengths, slant_ranges, heights)
+    corrected = heights > 0
+    if corrected.any():
+        return float(ground_ranges[corrected].max())
+    return float(ground_ranges.max())
+
+
+def sampleIndices(lengths, slant_ranges, heights, ground):
+    """
+    Fractional sample indices of ground distances (1D array, meters) for every ping.
+    Distances beyond the end of ping are OUTSIDE
+    """
+    samples = np.hypot(ground[np.newaxis, :], heights[:, np.newaxis]) * (lengths / slant_ranges)[:, np.newaxis]
+    return np.where(samples <= (lengths - 1)[:, np.newaxis], samples, OUTSIDE)
+
+
+def groundRangeMap(port, stbd, port_width, ground_range, width):
+    """
+    map_x for cv2.remap of pings stacked as [port | starboard] rows,
+    port_width is width of port part, port samples are not inversed.
+    port and stbd are tuples (lengths, slant_ranges, heights) of channel.
+    Output row is [port | starboard] with nadir in the middle,
+    each channel has width pixels from 0 to ground_range meters
+    """
+    ground = np.linspace(0, ground_range, width)
+    port_lengths = port[0]
+    port_samples = sampleIndices(*port, ground)
+    stbd_samples = sampleIndices(*stbd, ground)
+    port_map = np.where(port_samples >= 0, (port_lengths - 1)[:, np.newaxis] - port_samples, OUTSIDE)
+    stbd_map = np.where(stbd_samples >= 0, port_width + stbd_samples, OUTSIDE)
+    return np.concatenate((port_map[:, ::-1], stbd_map), axis=1).astype(np.float32)
+
+
+def remapRows(src, map_x):
+    """
+    Resample every row of src with map_x.
+    Output is remapped by blocks of columns, each block with cv2.remap of source columns it samples.
+    Blocks sampling too wide part of source are resampled with map_coordinates.
+    As in slant range correction before, values inside ping are not less than 1
+    """
+    output = np.zeros(map_x.shape, dtype=src.dtype)
+    rows = np.arange(src.shape[0], dtype=np.float32)[:, np.newaxis]
+    for start in range(0, map_x.shape[1], REMAP_MAX_SIZE):
+        stop = min(start + REMAP_MAX_SIZE, map_x.shape[1])
+        block_x = map_x[:, start:stop]
+        inside = block_x >= 0
+        if not inside.any():
+            continue
+        first = int(block_x[inside].min())
+        last = min(int(block_x[inside].max()) + 2, src.shape[1])
+        # Map values outside of pings stay negative
+        block_x = block_x - first
+        block_y = np.repeat(rows, stop - start, axis=1)
+        if last - first < REMAP_MAX_SIZE:
+            output[:, start:stop] = cv2.remap(src[:, first:last], block_x, block_y, cv2.INTER_LINEAR,
+                                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        else:
+            output[:, start:stop] = map_coordinates(src[:, first:last], (block_y, block_x),
+                                                    order=1, mode='constant', cval=0)
+    np.maximum(output, 1, out=output, where=map_x >= 0)
+    return output
@@ -0,0 +1,133 @@
+"""
+Module to draw mosaic of one line by inverse mapping.
+For every pixel of map the source ping and sample are found from smoothed track and rotations,
+then waterfall is sampled by one cv2.remap for a block of map. Work depends on number
+of map pixels instead of number of stripes, and there are no gaps between stripes.
+"""
+
+import numpy as np
+import cv2
+from scipy.spatial import cKDTree
+from scipy.ndimage import map_coordinates
+
+# cv2.remap works with images smaller than 32767 pixels on each side
+REMAP_MAX_SIZE = 32000
+# Pixels between nodes of grid where source ping and sample are found by nearest ping
+MAP_GRID_STEP = 8
+
+
+class LineRenderer:
+
+    def __init__(self, image, ping_starts, track, rotations, swath_widths):
+        """
+        image is full image of line (row 0 is the last ping, see SonarData.fullImage),
+        ping_starts are first pings of stripes, track and rotations are smoothed positions
+        and rotations of stripes (see TrackProcess), swath_widths are widths of swath of pings in meters.
+        Position of stripe is position of its first ping, positions and headings of other pings are interpolated
+        """
+        self.image = image
+        self.pings_num = image.shape[0]
+        self.width = image.shape[1]
+        ping_starts = np.asarray(ping_starts, dtype=np.float64)
+        track = np.asarray(track, dtype=np.float64)
+        # Rotation of stripe is minus heading (clockwise from north), see Utils.calcRotBtwPoints
+        headings = np.unwrap(-np.radians(np.asarray(rotations, dtype=np.float64)))
+
+        # Pings of the last stripe are placed with speed of previous stripe
+        last_ping = self.pings_num - 1
+        if len(ping_starts) > 1 and ping_starts[-1] < last_ping:
+            speed = (track[-1] - track[-2]) / (ping_starts[-1] - ping_starts[-2])
+            track = np.vstack((track, track[-1] + speed * (last_ping - ping_starts[-1])))
+            headings = np.append(headings, headings[-1])
+            ping_starts = np.append(ping_starts, last_ping)
+
+        self.first_ping = int(ping_starts[0])
+        pings = np.arange(self.first_ping, int(ping_starts[-1]) + 1)
+        self.positions = np.column_stack((np.interp(pings, ping_starts, track[:, 0]),
+                                          np.interp(pings, ping_starts, track[:, 1])))
+        headings = np.interp(pings, ping_starts, headings)
+        # Along track and starboard unit vectors of pings
+        self.along = np.column_stack((np.sin(headings), np.cos(headings)))
+        self.across = np.column_stack((np.cos(headings), -np.sin(headings)))
+        # Meters between neighbour pings
+        steps = np.linalg.norm(np.diff(self.positions, axis=0), axis=1)
+        self.steps = np.concatenate((steps[:1], (steps[1:] + steps[:-1]) / 2, steps[-1:])) if len(steps) else np.zeros(1)
+        self.meters_per_sample = np.asarray(swath_widths, dtype=np.float64)[pings] / self.width
+        self.half_swath = float(np.max(self.meters_per_sample)) * self.width / 2
+        self.tree = cKDTree(self.positions)
+
+
+    def getCornersGK(self):
+        """
+        Top left and bottom right corners of area covered by swath
+        """
+        left, bottom = self.positions.min(axis=0) - self.half_swath
+        right, top = self.positions.max(axis=0) + self.half_swath
+        return (left, top), (right, bottom)
+
+
+    def _sourceCoordinates(self, points):
+        """
+        Fractional rows of full image and samples of points in meters, found from the nearest ping.
+        Points outside of swath get samples or rows outside of image
+        """
+        nearest = self.tree.query(points)[1]
+        offsets = points - self.positions[nearest]
+        along = np.einsum('ij,ij->i', offsets, self.along[nearest])
+        across = np.einsum('ij,ij->i', offsets, self.across[nearest])
+        steps = self.steps[nearest]
+        pings = nearest + np.divide(along, steps, out=np.zeros_like(along), where=steps > 0)
+        samples = across / self.meters_per_sample[nearest] + (self.width / 2 - 0.5)
+        # Full image starts with the last ping
+        image_rows = (self.pings_num - 1 - self.first_ping) - pings
+        return image_rows, samples
+
+
+    def renderBlock(self, left, top, width, height, scale):
+        """
+        Image and alpha of block of map with top left corner (left, top) in meters,
+        width and height in pixels and scale in pixels per meter.
+        None if swath doesn't cover block
+        """
+        # Block far from track is skipped without looking at its pixels
+        diagonal = np.hypot(width, height) / scale
+        center = (left + width / (2 * scale), top - height / (2 * scale))
+        if self.tree.query(center)[0] > self.half_swath + diagonal / 2:
+            return None
+
+        # Source coordinates are found for nodes of grid and interpolated between them
+        grid_cols = np.arange(0, width - 1 + MAP_GRID_STEP, MAP_GRID_STEP)
+        grid_rows = np.arange(0, height - 1 + MAP_GRID_STEP, MAP_GRID_STEP)
+        points = np.column_stack((np.tile(left + (grid_cols + 0.5) / scale, len(grid_rows)),
+                                  np.repeat(top - (grid_rows + 0.5) / scale, len(grid_cols))))
+        image_rows, samples = self._sourceCoordinates(points)
+        first_row = max(int(np.floor(image_rows.min())), 0)
+        last_row = min(int(np.ceil(image_rows.max())) + 1, self.pings_num)
+        if first_row >= last_row:
+            return None
+        grid_shape = (len(grid_rows), len(grid_cols))
+        node_x = np.broadcast_to(np.arange(width, dtype=np.float32) / MAP_GRID_STEP, (height, width)).copy()
+        node_y = np.broadcast_to(np.arange(height, dtype=np.float32)[:, np.newaxis] / MAP_GRID_STEP,
+                                 (height, width)).copy()
+        map_x = cv2.remap(samples.reshape(grid_shape).astype(np.float32), node_x, node_y, cv2.INTER_LINEAR)
+        map_y = cv2.remap((image_rows - first_row).reshape(grid_shape).astype(np.float32), node_x, node_y,
+                          cv2.INTER_LINEAR)
+        # Only samples of block are remapped
+        first_col = max(int(np.floor(map_x.min())), 0)
+        last_col = min(int(np.floor(map_x.max())) + 2, self.width)
+        if first_col >= last_col:
+            return None
+        map_x -= first_col
+
+        # Samples outside of image are transparent
+        source = self.image[first_row:last_row, first_col:last_col]
+        if max(source.shape) < REMAP_MAX_SIZE:
+            block = cv2.remap(source, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        else:
+            # Block covers pings far from each other (e.g. line crosses itself) or very long pings
+            block = map_coordinates(source, (map_y, map_x), order=1, mode='constant', cval=0).astype(self.image.dtype)
+        # Samples with zero value are transparent as in SonarImageGK
+        alpha = cv2.compare(block, 0, cv2.CMP_NE)
+        if not alpha.any():
+            return None
+        return block, alpha
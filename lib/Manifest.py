@@ -0,0 +1,56 @@
+"""
+Module to keep manifest of batch run outputs in proc folder.
+For every processed XTF file (or its part) and stage the manifest records key of inputs
+(file fingerprint and settings that affect the stage) and output files,
+so later runs rebuild only outputs that are stale or missing.
+"""
+
+import os
+import json
+from lib.io import FileNaming, saveJson
+
+MANIFEST_NAME = 'manifest.json'
+# Change when manifest format or stage keys change, so everything is rebuilt once
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.file_name = os.path.join(directory, FileNaming.proc_name, MANIFEST_NAME)
+        self.entries = {}
+        try:
+            with open(self.file_name, 'r') as f_read:
+                manifest = json.load(f_read)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.entries = manifest['entries']
+        except (OSError, ValueError, KeyError):
+            pass
+
+
+    def getRecord(self, name, stage):
+        return self.entries.get(name, {}).get(stage)
+
+
+    def isFresh(self, name, stage, key):
+        """
+        True if stage of name was done with the same key and all its outputs exist
+        """
+        record = self.getRecord(name, stage)
+        return record is not None and record['key'] == key and \
+               all(os.path.isfile(os.path.join(self.directory, output)) for output in record['outputs'])
+
+
+    def update(self, name, stage, key, outputs, **info):
+        """
+        Record done stage with its output files and extra info, manifest is saved at once
+        """
+        outputs = [os.path.relpath(output, self.directory) for output in outputs]
+        self.entries.setdefault(name, {})[stage] = dict(key=key, outputs=outputs, **info)
+        self.save()
+
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        saveJson(self.file_name, {'version': MANIFEST_VERSION, 'entries': self.entries})
@@ -7,10 +7,30 @@ Each sonar bit should correspond to one navigation point.
 from lib.SonarData import SonarStripe
 from lib.dtypes import GKpoint, MapPoint
 from lib.Utils import getSizeFromRotation, formTranslationRotationMtx
+from lib.TiledCanvas import TiledCanvas, DiskTiledCanvas, TILE_SIZE
 import numpy as np
 import cv2
 from matplotlib import pyplot as plt
 
+# Canvas kinds: one array over bounding box of track, tiles allocated under stripes
+# or such tiles kept on disk with limited memory
+DENSE_CANVAS = 'dense'
+TILED_CANVAS = 'tiled'
+DISK_CANVAS = 'disk'
+# Longest side of preview image of map
+PREVIEW_SIZE = 2048
+
+def colormapLut(name):
+    """
+    Table of 256 RGB colors of matplotlib colormap for gray values
+    """
+    try:
+        colormap = plt.get_cmap(name)
+    except ValueError:
+        raise ValueError(f'Unknown colormap: {name}')
+    return np.round(colormap(np.arange(256))[:, :3] * 255).astype(np.uint8)
+
+
 class SonarImageGK:
     """
     Class that holds image with precalculated parameters
@@ -24,10 +44,8 @@ class SonarImageGK:
         self.image = cv2.resize(img.image, new_size)
         # # Make darkest value 1
         # self.image[self.image<1] = 1
-        # Convert to BGR
-        self.image = cv2.cvtColor(self.image, cv2.COLOR_GRAY2RGB)
-        self.alpha = np.ones(self.image.shape).astype(np.uint8)*255
-        self.alpha[self.image==0] = 0
+        # Image and alpha are single band, colors are applied to the whole map (see MapDrawer)
+        self.alpha = cv2.compare(self.image, 0, cv2.CMP_NE)
 
         # Store attributes
         self.shape = self.image.shape # Height First, width second, as in numpy
@@ -88,10 +106,21 @@ class MapDrawer:
     Generates map with track and sonar data in Gauss Kruger coordinates.
     """
 
-    def __init__(self, scale):
+    def __init__(self, scale, canvas_kind=DENSE_CANVAS, tiles_folder=None, memory_limit=0, colormap=''):
+        """
+        tiles_folder and memory_limit (bytes of tiles in memory) are used by disk canvas.
+        Map is grayscale, colormap is name of matplotlib colormap for RGB output, '' for grayscale
+        """
         self.track = None
         self.sonar_images = []
         self.map_scale = scale # Pixel per meter
+        self.canvas_kind = canvas_kind
+        self.tiled = canvas_kind in (TILED_CANVAS, DISK_CANVAS)
+        self.tiles_folder = tiles_folder
+        self.memory_limit = memory_limit
+        self._scratch_buffers = {}
+        self.colormap = colormap
+        self._colormap_lut = colormapLut(colormap) if colormap else None
         print('Created MapDrawer object')
 
 
@@ -106,8 +135,16 @@ class MapDrawer:
         height = int((latTL - latBR) * self.map_scale)
 
         # Store canvas and limits
-        self.canvas = 255*np.ones((height, width, 3)).astype(np.uint8)
-        self.alpha = 255*np.zeros((height, width, 3)).astype(np.uint8)
+        if self.canvas_kind == DISK_CANVAS:
+            self.canvas = DiskTiledCanvas(height, width, self.tiles_folder, self.memory_limit)
+            self.alpha = None
+        elif self.canvas_kind == TILED_CANVAS:
+            # Tiles are allocated by placeStripeOnCanvas, alpha is kept in tiles
+            self.canvas = TiledCanvas(height, width)
+            self.alpha = None
+        else:
+            self.canvas = np.full((height, width), 255, dtype=np.uint8)
+            self.alpha = np.zeros((height, width), dtype=np.uint8)
         self.XminGK = lonTL
         self.XmaxGK = lonBR
         self.YmaxGK = latTL
@@ -121,35 +158,84 @@ class MapDrawer:
         stripe_center = self.PtGKtoImg(stripe.center_coordinate_GK)
         TL_corner = (stripe_center[0] - stripe.width // 2,
                     stripe_center[1] - stripe.height // 2)
-        
-        # Calculate alpha
-        background = self.canvas[TL_corner[1] : TL_corner[1] + stripe.height,
-                    TL_corner[0] : TL_corner[0] + stripe.width, :]
-        
 
-        inv_alpha = 255 - stripe.alpha
+        if self.tiled:
+            # Stripe is split by tiles it overlaps
+            for key, tile_region, stripe_region in self.canvas.regions(TL_corner[1], TL_corner[0],
+                                                                       stripe.height, stripe.width):
+                tile_image, tile_alpha = self.canvas.getTile(key)
+                self._composite(tile_image[tile_region], tile_alpha[tile_region],
+                                stripe.image[stripe_region], stripe.alpha[stripe_region])
+            return
 
-        bg = background.astype(np.float32) / 255
-        al = stripe.alpha.astype(np.float32) / 255
+        rows = slice(TL_corner[1], TL_corner[1] + stripe.height)
+        cols = slice(TL_corner[0], TL_corner[0] + stripe.width)
+        self._composite(self.canvas[rows, cols], self.alpha[rows, cols], stripe.image, stripe.alpha)
 
-        # inv_alpha = cv2.dilate(1.0 - al, kernel)
-        inv_alpha = 1.0 - al
-        msk = bg * (inv_alpha)
 
-        new = msk + stripe.image.astype(np.float32) / 255
+    def placeLineOnCanvas(self, renderer):
+        """
+        Draw the whole line by inverse mapping (see LineRenderer) block by block,
+        blocks are tiles of tiled canvas, so only tiles covered by swath are allocated
+        """
+        height, width = self.getImgSize()
+        block_size = self.canvas.tile_size if self.tiled else TILE_SIZE
+        for top in range(0, height, block_size):
+            for left in range(0, width, block_size):
+                rows = min(block_size, height - top)
+                cols = min(block_size, width - left)
+                block = renderer.renderBlock(self.XminGK + left / self.map_scale,
+                                             self.YminGK + (height - top) / self.map_scale,
+                                             cols, rows, self.map_scale)
+                if block is None:
+                    continue
+                image, alpha = block
+                if self.tiled:
+                    tile_image, tile_alpha = self.canvas.getTile((top // block_size, left // block_size))
+                    self._composite(tile_image, tile_alpha, image, alpha)
+                else:
+                    self._composite(self.canvas[top : top + rows, left : left + cols],
+                                    self.alpha[top : top + rows, left : left + cols], image, alpha)
+
+
+    def _composite(self, background, background_alpha, image, alpha):
+        """
+        Blend stripe over part of canvas in place in uint8:
+        background * (255 - alpha) / 255 + image, image of stripe is black where it's transparent.
+        Canvas alpha is saturated sum of alphas. Views of canvas are changed by cv2 directly,
+        only reused scratch buffer is used
+        """
+        if background.size == 0:
+            return
+        inv_alpha = self._scratch(alpha.shape)
+        cv2.bitwise_not(alpha, dst=inv_alpha)
+        cv2.multiply(background, inv_alpha, dst=background, scale=1 / 255)
+        cv2.add(background, image, dst=background)
+        cv2.add(background_alpha, alpha, dst=background_alpha)
 
-        # Return on canvas
-        self.canvas[TL_corner[1] : TL_corner[1] + stripe.height,
-                    TL_corner[0] : TL_corner[0] + stripe.width, :] = (255.0 * new).astype(np.uint8)
-        
-        # Update canvas alpha
-        raw_alpha = self.alpha[TL_corner[1] : TL_corner[1] + stripe.height,
-                    TL_corner[0] : TL_corner[0] + stripe.width]
 
-        res_alpha = cv2.add(raw_alpha, stripe.alpha)
+    def _scratch(self, shape):
+        """
+        Uint8 buffer of shape, view of buffer kept between stripes.
+        Buffer grows when stripe is larger than all previous
+        """
+        buffer = self._scratch_buffers.get(len(shape))
+        if buffer is None or any(size < need for size, need in zip(buffer.shape, shape)):
+            new_shape = shape if buffer is None else \
+                        tuple(max(size, need) for size, need in zip(buffer.shape, shape))
+            buffer = np.empty(new_shape, dtype=np.uint8)
+            self._scratch_buffers[len(shape)] = buffer
+        return buffer[tuple(slice(0, need) for need in shape)]
 
-        self.alpha[TL_corner[1] : TL_corner[1] + stripe.height,
-                    TL_corner[0] : TL_corner[0] + stripe.width] = res_alpha
+
+    def deleteCanvas(self):
+        """
+        Free canvas, tiles of disk canvas are removed from disk
+        """
+        if self.canvas_kind == DISK_CANVAS:
+            self.canvas.close()
+        self.canvas = None
+        self.alpha = None
 
 
     def PtGKtoImg(self, pt : GKpoint):
@@ -164,16 +250,70 @@ class MapDrawer:
 
 
     def getImage(self):
+        """
+        Grayscale map
+        """
+        if self.tiled:
+            return self.canvas.toArrays()[0]
         return self.canvas
     
     def getAlpha(self):
-        return self.alpha[:,:,0]
+        if self.tiled:
+            return self.canvas.toArrays()[1]
+        return self.alpha
     
+    def getBandsCount(self):
+        """
+        Bands of transparent map: gray and alpha or RGB and alpha when colormap is used
+        """
+        return 2 if self._colormap_lut is None else 4
+
+    def _transparent(self, image, alpha):
+        if self._colormap_lut is None:
+            return np.dstack((image, alpha))
+        return np.dstack((self._colormap_lut[image], alpha))
+
     def getTransparent(self):
-        out = np.zeros((self.canvas.shape[0], self.canvas.shape[1], 4))
-        out[:,:,:3] = self.canvas
-        out[:,:,3] = self.alpha[:,:,0]
-        return out.astype(np.uint8)
+        """
+        Map with alpha as last band, see getBandsCount
+        """
+        return self._transparent(self.getImage(), self.getAlpha())
+
+    def getTransparentTiles(self):
+        """
+        Parts of transparent map to write one by one: row and column of top left pixel, array as in getTransparent.
+        Tiled canvas gives only allocated tiles, the rest of map is transparent
+        """
+        if not self.tiled:
+            yield 0, 0, self.getTransparent()
+            return
+        for top, left, image, alpha in self.canvas.iterTiles():
+            yield top, left, self._transparent(image, alpha)
+
+    def getPreview(self, max_size=PREVIEW_SIZE):
+        """
+        Map image reduced to max_size pixels on longest side, without building full image of tiled canvas.
+        Colormap is applied to preview if it's used
+        """
+        height, width = self.getImgSize()
+        scale = min(1.0, max_size / max(height, width, 1))
+        if not self.tiled:
+            if scale == 1.0:
+                preview = self.canvas
+            else:
+                preview = cv2.resize(self.canvas, (max(int(width * scale), 1), max(int(height * scale), 1)),
+                                     interpolation=cv2.INTER_AREA)
+        else:
+            preview = np.full((max(int(height * scale), 1), max(int(width * scale), 1)), 255, dtype=np.uint8)
+            for top, left, image, _ in self.canvas.iterTiles():
+                y0, x0 = int(top * scale), int(left * scale)
+                y1 = min(int((top + image.shape[0]) * scale), preview.shape[0])
+                x1 = min(int((left + image.shape[1]) * scale), preview.shape[1])
+                if y1 > y0 and x1 > x0:
+                    preview[y0:y1, x0:x1] = cv2.resize(image, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+        if self._colormap_lut is not None:
+            return self._colormap_lut[preview]
+        return preview
     
     def getCornersGK(self):
         # Get GK coordinates in orderL: Left, Right, Bottom, Top
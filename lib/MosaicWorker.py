@@ -4,13 +4,17 @@ from PySide6.QtCore import QObject, Signal, Slot
 import gc
 from lib.Settings import Settings
 from lib.SonarData import SonarData
+from lib.XTFReader import PINGS_VERSION, NoPingsError
 from lib.Georef import Georef
 from lib.io import FileNaming
-from lib.GausKruger import GausKruger
+from lib.Projection import Projection
 from tkinter.filedialog import askdirectory
-from lib.MapDrawer import MapDrawer, SonarImageGK
+from lib.MapDrawer import MapDrawer, SonarImageGK, colormapLut
+from lib.LineRenderer import LineRenderer
 from lib.PictureViewer import PictureViewer
-from lib.io import loadCsvGK, npToCsv
+from lib.io import npToCsv, cacheKey, saveTrack, loadTrack, WGS_CSV_FORMAT, PLANE_CSV_FORMAT
+from lib.Manifest import Manifest
+from lib.StageCache import StageCache
 from lib.TrackProcess import TrackProcess
 import glob
 import os
@@ -19,6 +23,8 @@ from skimage import io
 from matplotlib import pyplot as plt
 import rasterio
 from rasterio.transform import from_origin
+from rasterio.windows import Window
+from rasterio.enums import ColorInterp
 import traceback
 
 
@@ -61,8 +67,10 @@ class MosaicWorker(QObject):
     def process(self):
         self._abort = False
         try:
-            self._process()
-            self.finished.emit()
+            if self._process():
+                self.finished.emit()
+            else:
+                self.cancelled.emit()
         except BaseException as e:
             # This block catches the exception
             self.status.emit(f"An exception occurred: {e}\nException type: {type(e).__name__}") # Prints a user-friendly message and the error message
@@ -70,6 +78,129 @@ class MosaicWorker(QObject):
             self.cancelled.emit()
 
 
+    def _openSonarData(self, xtf_file, naming : FileNaming, status_head):
+        """
+        SonarData of XTF file with current settings, None if it can't be read.
+        NoPingsError is raised if file has no pings in chosen time
+        """
+        try:
+            return SonarData(xtf_file, naming.get_index_name(), self.settings.workers,
+                             self.settings.channels, self.settings.time_window())
+        except FileNotFoundError:
+            self.status.emit(f'{status_head}Missed files')
+        except NoPingsError:
+            raise
+        except ValueError as e:
+            # Wrong sonar channels
+            self.status.emit(f'{status_head}{e}')
+        return None
+
+
+    def _exportTracks(self, xtf_list, manifest : Manifest):
+        """
+        Write tracks of all XTF files to binary track files in proc folder
+        (and to CSV files if export_csv is set).
+        Tracks are projected in one call into one coordinate system for the whole survey
+        (see Projection module), so mosaics of all lines can be merged.
+        XTF file is not read if its track file was made of the same pings.
+        Files without pings in chosen time are skipped.
+        Returns projection, lists of the other XTF files, their namings and projected tracks as np arrays,
+        None if some file can't be read
+        """
+        all_namings = [FileNaming(xtf_file, self.settings.subset_name()) for xtf_file in xtf_list]
+        xtf_files = []
+        namings = []
+        times_list = []
+        tracks = []
+        for xtf_index, (xtf_file, naming) in enumerate(zip(xtf_list, all_namings)):
+            status_head = f'File {xtf_index + 1} of {len(xtf_list)} - {xtf_file}:\n'
+            pings_key = self._pingsKey(naming)
+            try:
+                stored = loadTrack(naming.get_track_name())
+            except (OSError, ValueError, KeyError):
+                stored = None
+            if stored is not None and stored['source_key'] == pings_key:
+                times = stored['time']
+                track = stored['wgs84']
+            else:
+                try:
+                    sonar_data = self._openSonarData(xtf_file, naming, status_head)
+                except NoPingsError as e:
+                    self.status.emit(f'{status_head}{e}, file is skipped')
+                    continue
+                if sonar_data is None:
+                    return None
+                times = sonar_data.extractPingTimes()
+                track = sonar_data.extractTrackWGS84()
+                del sonar_data
+            xtf_files.append(xtf_file)
+            namings.append(naming)
+            times_list.append(times)
+            tracks.append(track)
+
+        if not xtf_files:
+            self.status.emit('No files with pings in chosen time')
+            return None, [], [], []
+        projection = Projection.forSurvey(self.settings.projection, tracks)
+        self.status.emit(f'Tracks are projected to {projection}')
+        tracks_xy = projection.projectTracks(tracks)
+        for xtf_file, naming, times, track, track_xy in zip(xtf_files, namings, times_list, tracks, tracks_xy):
+            manifest_name = os.path.basename(xtf_file) + naming.subset_name
+            tracks_key = self._stageKeys(naming, projection)['tracks']
+            # CSV files don't change results of next stages, so they are not in tracks key
+            export_key = cacheKey(tracks_key, int(self.settings.export_csv))
+            if manifest.isFresh(manifest_name, 'tracks', export_key):
+                continue
+            track_file = naming.get_track_name()
+            saveTrack(track_file, times, track, track_xy, projection.crs, self._pingsKey(naming))
+            outputs = [track_file]
+            self.status.emit(f'Writing file {track_file} done')
+
+            if self.settings.export_csv:
+                track_WGS_file = naming.get_track_WGS_name()
+                track_GK_file = naming.get_track_GK_name()
+                georef = naming.get_track_georef_name()
+                npToCsv(track_WGS_file, track, WGS_CSV_FORMAT)
+                Georef().makeSurferGeorefWGS84(georef)
+                npToCsv(track_GK_file, track_xy, PLANE_CSV_FORMAT)
+                outputs += [track_WGS_file, track_GK_file, georef]
+                self.status.emit(f'Writing files {track_WGS_file}, {track_GK_file} done')
+            manifest.update(manifest_name, 'tracks', export_key, outputs, crs=projection.crs)
+        return projection, xtf_files, namings, tracks_xy
+
+
+    def _pingsKey(self, naming : FileNaming):
+        """
+        Key of pings chosen from XTF file: its content, sonar channels and time window
+        """
+        settings = self.settings
+        return cacheKey(naming.get_fingerprint(), PINGS_VERSION, *settings.channels,
+                        settings.start_time, settings.end_time)
+
+
+    def _stageKeys(self, naming : FileNaming, projection : Projection):
+        """
+        Keys of pipeline stages of XTF file: hashes of its content and settings
+        that change the stage result, each key includes keys of stages it depends on.
+        Number of worker processes doesn't change anything
+        """
+        settings = self.settings
+        keys = {}
+        # Exported tracks and pings of file
+        keys['tracks'] = cacheKey(self._pingsKey(naming), projection.crs)
+        # Ground range waterfall
+        keys['ground_range'] = cacheKey(keys['tracks'], settings.startsearchbottom,
+                                        settings.corsltrng_searchwindow, settings.corsltrng_frst_refl_bias)
+        # Smoothed track with cable out and rotations of stripes
+        keys['track'] = cacheKey(keys['tracks'], settings.corwindow, settings.cable_out)
+        # Corners of rotated stripes, their width depends on slant range correction
+        keys['footprints'] = cacheKey(keys['track'], settings.map_scale, settings.stripescale,
+                                      keys['ground_range'] if settings.correct_slantrange else None)
+        keys['mosaic'] = cacheKey(keys['footprints'], settings.map_margins, settings.gamma, settings.colormap,
+                                  settings.renderer)
+        return keys
+
+
     @Slot(str)
     def _process(self):
         self.image.emit(None)
@@ -79,68 +210,53 @@ class MosaicWorker(QObject):
         # print(xtf_list)
         self.status.emit('\n'.join(xtf_list))
 
-        # Process data
-        for xtf_file in xtf_list:
-            if self._abort:
-                self.status.emit("Processing cancelled")
-                self.cancelled.emit()
-                return
+        # Wrong colormap fails before processing
+        if self.settings.colormap:
+            colormapLut(self.settings.colormap)
 
-            naming = FileNaming(xtf_file)
-            # track_file = '.'.join(xtf_file.split('.')[:-1]) + '.csv'
-            # georef = track_file + '.gsr2'
-            track_file = naming.get_track_WGS_name()
-            track_GK_file = naming.get_track_GK_name()
-            georef = naming.get_track_georef_name()
+        # Outputs that are up to date with XTF file and settings are not rebuilt
+        manifest = Manifest(self.settings.directory)
+        # Results of stages, reruns with other settings start from the first changed stage
+        stage_cache = StageCache(self.settings.directory, self.settings.cache_size * 2**20)
 
-            sonar_data = SonarData(xtf_file)
-
-            track = sonar_data.extractTrackWGS84()
-            with open(track_file, 'w') as wfile:
-                for line in track:
-                    wfile.write(f'{line[0]};{line[1]}\n')
-            self.status.emit(f'Writing file {track_file} done')
-            gr = Georef()
-            gr.makeSurferGeorefWGS84(georef)
-
-            # Gauss Kruger
-            GK = GausKruger()
-            with open(track_GK_file, 'w') as wfile:
-                lon = track[:,0]
-                lat = track[:,1]
-                GK_X, GK_Y, GK_zone = GK.transform_to_gauss_kruger(lat, lon)
-                for x, y in zip(GK_X, GK_Y):
-                    wfile.write(f'{x};{y}\n')
-            self.status.emit(f'Writing file {track_file} done')
+        exported = self._exportTracks(xtf_list, manifest)
+        if exported is None:
+            return False
+        # Files without pings in chosen time are not in lists
+        projection, xtf_list, namings, tracks_xy = exported
 
-    # Generate maps
-        for xtf_index, xtf_file in enumerate(xtf_list):
+        # Process data: mosaic is built for every XTF file
+        for xtf_index, (xtf_file, naming, track_input) in enumerate(zip(xtf_list, namings, tracks_xy)):
             status_head = f'File {xtf_index + 1} of {len(xtf_list)} - {xtf_file}:\n'
             if self._abort:
                 self.status.emit("Processing cancelled")
-                self.cancelled.emit()
-                return
-            naming = FileNaming(xtf_file)
-            track_GK_file = naming.get_track_GK_name()
+                return False
             map_file = naming.get_map_name()
             geotiff_file = naming.get_geotiff_name()
             map_georef_file = naming.get_map_georef_name()
+            manifest_name = os.path.basename(xtf_file) + naming.subset_name
+            keys = self._stageKeys(naming, projection)
+            if manifest.isFresh(manifest_name, 'mosaic', keys['mosaic']):
+                self.status.emit(f'{status_head}Mosaic is up to date')
+                continue
 
-            try:
-
-                track_input = loadCsvGK(track_GK_file)
-                sonar_data = SonarData(xtf_file)
+            sonar_data = self._openSonarData(xtf_file, naming, status_head)
+            if sonar_data is None:
+                return False
 
-                sonar_data.generateFullImage()
-                sonar_data.gammaCorrect(self.settings.gamma)
-                self.image.emit(sonar_data.fullImage)
-            except FileNotFoundError:
-                self.status.emit(f'{status_head}Missed files')
-                self.cancelled.emit()
-                return
-
-            if self.settings.correct_slantrange:
-                bottom_file = naming.get_bottom_file_name()
+            sonar_data.gammaCorrect(self.settings.gamma)
+            cached = stage_cache.load('ground_range', keys['ground_range']) \
+                     if self.settings.correct_slantrange else None
+            if cached is not None:
+                self.status.emit(f'{status_head}Slant range correction found in cache')
+                sonar_data.setWaterfall(cached['waterfall'], float(cached['ground_range']))
+            self.image.emit(sonar_data.fullImage)
+
+            if self.settings.correct_slantrange and cached is None:
+                bottom_file = naming.get_bottom_file_name(self.settings.startsearchbottom,
+                                                          self.settings.corsltrng_searchwindow,
+                                                          self.settings.corsltrng_frst_refl_bias,
+                                                          self.settings.channels)
                 if os.path.isfile(bottom_file):
                     self.status.emit(f'{status_head}Data found. Applying slant range correction')
                     sonar_data.correctSlantRange(self.settings.startsearchbottom,
@@ -148,56 +264,85 @@ class MosaicWorker(QObject):
                                             self.settings.corsltrng_searchwindow,
                                             self.settings.corsltrng_frst_refl_bias,
                                             store_file=bottom_file,
-                                            data_provided=True)
+                                            data_provided=True,
+                                            workers=self.settings.workers)
                 else:
                     self.status.emit(f'{status_head}Calculating and applying slant range correction')
                     sonar_data.correctSlantRange(self.settings.startsearchbottom,
                                             self.settings.debug,
                                             self.settings.corsltrng_searchwindow,
                                             self.settings.corsltrng_frst_refl_bias,
-                                            store_file=bottom_file)
-            sonar_data.gammaCorrect(self.settings.gamma)
+                                            store_file=bottom_file,
+                                            workers=self.settings.workers)
+                naming.remove_stale_bottom_files(bottom_file)
+                # Bottom file name is its key
+                manifest.update(manifest_name, 'bottom', os.path.basename(bottom_file), [bottom_file])
+                stage_cache.save('ground_range', keys['ground_range'],
+                                 waterfall=sonar_data.getWaterfall(),
+                                 ground_range=np.array(sonar_data.ground_range))
             sonar_data.loadGK(track_input)
             sonar_stripes = sonar_data.splitIntoGKStripes()
 
-            # Get rotations
-            track_proc = TrackProcess(sonar_stripes)
-
-            # plt.plot(track_proc.getTrackRotations(), label='Raw')
-
-            
-            # Update track rotations
-            track_proc.smoothRotations(self.settings.corwindow, 2)
-            # plt.plot(track_proc.getTrackRotations(), label='Pre-smoothed')
-
-            # Cable out
-            track_proc.inputCableOut(self.settings.cable_out)
-            track_proc.updateCableOut()
-            track_proc.smoothRotations(self.settings.corwindow, 2)
-
-            
-            offseted_track = track_proc.getTrack()
-            rotations = track_proc.getTrackRotations()
+            cached = stage_cache.load('track', keys['track'])
+            if cached is not None:
+                offseted_track = [tuple(point) for point in cached['track'].tolist()]
+                rotations = cached['rotations'].tolist()
+            else:
+                # Get rotations
+                track_proc = TrackProcess(sonar_stripes)
+
+                # plt.plot(track_proc.getTrackRotations(), label='Raw')
+
+                
+                # Update track rotations
+                track_proc.smoothRotations(self.settings.corwindow, 2)
+                # plt.plot(track_proc.getTrackRotations(), label='Pre-smoothed')
+
+                # Cable out
+                track_proc.inputCableOut(self.settings.cable_out)
+                track_proc.updateCableOut()
+                track_proc.smoothRotations(self.settings.corwindow, 2)
+
+                
+                offseted_track = track_proc.getTrack()
+                rotations = track_proc.getTrackRotations()
+                stage_cache.save('track', keys['track'],
+                                 track=np.array(offseted_track, dtype=np.float64),
+                                 rotations=np.array(rotations, dtype=np.float64))
             self.status.emit(f'{status_head}Stripes are {len(sonar_stripes)}, rotations are {len(rotations)}')
 
-            # CALCULATE MARGINS
-            self.status.emit(f'{status_head}Processing track')
-            TL_coordsGK = []
-            BR_coordsGK = []
-
-            for stripe, rot, trackpoint in zip(sonar_stripes, rotations, offseted_track):
-                stripe_img = SonarImageGK(stripe, self.settings.map_scale, self.settings.stripescale)
-                stripe_img.updateCenterGK(trackpoint)
-                stripe_img.rotate(rot)
-                TL_coordsGK.append(stripe_img.getGKcoordTopLeft())
-                BR_coordsGK.append(stripe_img.getGKcoordBotRight())
-                # stripe_imgs.append(stripe_img)
-                # del stripe_img
-                # gc.collect()
-
-            # print('Estimating map limits')
-            TL_np = np.array(TL_coordsGK)
-            BR_np = np.array(BR_coordsGK)
+            if self.settings.renderer == 'inverse':
+                # Every pixel of map is sampled from the nearest ping, footprints of stripes are not needed
+                renderer = LineRenderer(sonar_data.fullImage, sonar_data.getStripePings()[0],
+                                        offseted_track, rotations, sonar_data.getSwathWidths())
+                top_left, bottom_right = renderer.getCornersGK()
+                TL_np = np.array([top_left])
+                BR_np = np.array([bottom_right])
+            else:
+                # CALCULATE MARGINS
+                self.status.emit(f'{status_head}Processing track')
+                cached = stage_cache.load('footprints', keys['footprints'])
+                if cached is not None:
+                    TL_np = cached['top_left']
+                    BR_np = cached['bottom_right']
+                else:
+                    TL_coordsGK = []
+                    BR_coordsGK = []
+
+                    for stripe, rot, trackpoint in zip(sonar_stripes, rotations, offseted_track):
+                        stripe_img = SonarImageGK(stripe, self.settings.map_scale, self.settings.stripescale)
+                        stripe_img.updateCenterGK(trackpoint)
+                        stripe_img.rotate(rot)
+                        TL_coordsGK.append(stripe_img.getGKcoordTopLeft())
+                        BR_coordsGK.append(stripe_img.getGKcoordBotRight())
+                        # stripe_imgs.append(stripe_img)
+                        # del stripe_img
+                        # gc.collect()
+
+                    # print('Estimating map limits')
+                    TL_np = np.array(TL_coordsGK)
+                    BR_np = np.array(BR_coordsGK)
+                    stage_cache.save('footprints', keys['footprints'], top_left=TL_np, bottom_right=BR_np)
 
             Map_topY = np.max(TL_np[:,1]) + self.settings.map_margins
             Map_leftX = np.min(TL_np[:,0]) - self.settings.map_margins
@@ -206,19 +351,24 @@ class MosaicWorker(QObject):
 
             self.status.emit(f"{status_head}TL corner: {Map_leftX}, {Map_topY}, BR corner: {Map_rgtX}, {Map_botY}")
 
-            mapGK = MapDrawer(self.settings.map_scale)
+            mapGK = MapDrawer(self.settings.map_scale, self.settings.canvas,
+                           naming.get_tiles_folder(), self.settings.tile_memory * 2**20,
+                           self.settings.colormap)
             mapGK.createCanvas((Map_leftX, Map_topY), (Map_rgtX, Map_botY))
 
             self.status.emit(f"{status_head}Building mosaic...")
 
-            for stripe, rot, trackpoint in zip(sonar_stripes, rotations, offseted_track):
-                stripe_img = SonarImageGK(stripe, self.settings.map_scale, self.settings.stripescale)
-                stripe_img.updateCenterGK(trackpoint)
-                stripe_img.rotate(rot)
-                mapGK.placeStripeOnCanvas(stripe_img)
+            if self.settings.renderer == 'inverse':
+                mapGK.placeLineOnCanvas(renderer)
+            else:
+                for stripe, rot, trackpoint in zip(sonar_stripes, rotations, offseted_track):
+                    stripe_img = SonarImageGK(stripe, self.settings.map_scale, self.settings.stripescale)
+                    stripe_img.updateCenterGK(trackpoint)
+                    stripe_img.rotate(rot)
+                    mapGK.placeStripeOnCanvas(stripe_img)
 
             # viewer = PictureViewer('Map', mapGK.getImage())
-            self.image.emit(mapGK.getImage())
+            self.image.emit(mapGK.getPreview())
             # viewer.show(10)
 
             margins = mapGK.getMarginMaps()
@@ -231,32 +381,36 @@ class MosaicWorker(QObject):
 
             # Calculate the transform (affine transformation matrix)
             transform = from_origin(left, top, (right - left) / width, (top - bottom) / height)
-            image0 = mapGK.getTransparent()
-            # MOVE CHANNEL AXES (RGB) to the beginning
-            image = np.moveaxis(image0.squeeze(),-1,0)
-
-            # Write the GeoTIFF file
+            # Write the GeoTIFF file by parts, tiled canvas gives only tiles under stripes,
+            # the rest of map stays transparent
             with rasterio.open(
                 geotiff_file,
                 'w',
                 driver='GTiff',
                 height=height,
                 width=width,
-                count=4,  # Number of bands
-                dtype=image.dtype,
-                crs=f'EPSG:{28400 + GK_zone}',  # Pulkovo 1942 coordinate system (example, adjust as needed)
+                count=mapGK.getBandsCount(),  # Gray or RGB and alpha
+                dtype=np.uint8,
+                crs=projection.crs,  # The same for all files of survey
                 transform=transform
             ) as dst:
                 self.status.emit(type(dst))
-                dst.write(image)  # Write the image data to the first band
+                color_bands = [ColorInterp.gray] if mapGK.getBandsCount() == 2 else \
+                              [ColorInterp.red, ColorInterp.green, ColorInterp.blue]
+                dst.colorinterp = color_bands + [ColorInterp.alpha]
+                for row, col, image in mapGK.getTransparentTiles():
+                    # MOVE CHANNEL AXES (bands) to the beginning
+                    dst.write(np.moveaxis(image, -1, 0), window=Window(col, row, image.shape[1], image.shape[0]))
 
             self.status.emit(f"GeoTIFF file saved as {geotiff_file}")
+            # Tiles of disk canvas are removed
+            mapGK.deleteCanvas()
+            manifest.update(manifest_name, 'mosaic', keys['mosaic'], [geotiff_file])
             del sonar_data
-            del image
             del sonar_stripes
             del mapGK
             # del stripe_imgs
             # del viewer
             gc.collect()
         self.status.emit("Processing finished")
-        return
\ No newline at end of file
+        return True
\ No newline at end of file
@@ -0,0 +1,75 @@
+"""
+Module with helpers to process chunks of pings in a process pool.
+Large arrays are passed to worker processes through shared memory.
+"""
+
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+# Pool is not started if there are less pings per worker than this
+MIN_PINGS_PER_WORKER = 1000
+# Every worker gets several chunks to balance the load
+CHUNKS_PER_WORKER = 4
+
+
+def workersCount(workers, pings_num, min_pings=MIN_PINGS_PER_WORKER):
+    """
+    Number of worker processes to use.
+    0 or less means all CPU cores, 1 means no process pool.
+    Every worker gets at least min_pings pings
+    """
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, pings_num // min_pings))
+
+
+def pingChunks(pings_num, workers):
+    """
+    Split pings into contiguous ranges (start, stop) in ping order
+    """
+    chunks_num = min(pings_num, workers * CHUNKS_PER_WORKER)
+    bounds = np.linspace(0, pings_num, chunks_num + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+class SharedArray:
+    """
+    Numpy array in shared memory.
+    Created in main process, worker processes attach to it by descriptor.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(dtype)
+        self._owner = name is None
+        if self._owner:
+            size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+
+    @classmethod
+    def attach(cls, descriptor):
+        name, shape, dtype = descriptor
+        return cls(shape, dtype, name)
+
+
+    def descriptor(self):
+        return (self.shm.name, self.shape, self.dtype.str)
+
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
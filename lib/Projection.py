@@ -0,0 +1,98 @@
+"""
+Module to project WGS84 tracks to plane coordinates.
+Transformers are created once for every pair of coordinate systems,
+all tracks of survey are projected in one call into one coordinate system,
+so mosaics of lines on both sides of zone boundary can be merged.
+"""
+
+from functools import lru_cache
+import numpy as np
+from pyproj import Transformer
+from pyproj.exceptions import CRSError
+
+WGS84 = 'EPSG:4326'
+# Pulkovo 1942 / Gauss-Kruger zone N
+GK_EPSG_BASE = 28400
+# WGS 84 / UTM zone N of northern and southern hemisphere
+UTM_NORTH_EPSG_BASE = 32600
+UTM_SOUTH_EPSG_BASE = 32700
+
+
+@lru_cache(maxsize=None)
+def getTransformer(source, target):
+    """
+    Transformer from source to target coordinate system, x is longitude or easting
+    """
+    try:
+        return Transformer.from_crs(source, target, always_xy=True)
+    except CRSError as e:
+        raise ValueError(f'Wrong coordinate system {source} or {target}: {e}')
+
+
+def gaussKrugerZone(longitude):
+    """Determine the Gauss-Kruger zone based on longitude."""
+    return int((longitude + 6) / 6)
+
+
+def utmZone(longitude):
+    return int((longitude + 180) // 6) % 60 + 1
+
+
+class Projection:
+    """
+    Plane coordinate system of survey, crs is any name known to pyproj, e.g. 'EPSG:28407'
+    """
+
+    def __init__(self, crs):
+        self.crs = crs
+        # Fails early for unknown coordinate system
+        getTransformer(WGS84, crs)
+
+
+    @classmethod
+    def forSurvey(cls, name, tracks):
+        """
+        Projection of survey with WGS84 tracks (arrays of longitude, latitude).
+        name is 'GK' or 'UTM' for zone chosen by the middle of all tracks,
+        or coordinate system name like 'EPSG:32637'
+        """
+        name = name.strip()
+        if name.upper() not in ('GK', 'UTM'):
+            return cls(name)
+
+        points = np.concatenate([np.asarray(track, dtype=np.float64).reshape(-1, 2) for track in tracks] +
+                                [np.empty((0, 2))])
+        # Pings without navigation have zero coordinates
+        points = points[np.isfinite(points).all(axis=1) & (points != 0).any(axis=1)]
+        if len(points) == 0:
+            raise ValueError('No coordinates in tracks to choose projection zone')
+        lon = (points[:, 0].min() + points[:, 0].max()) / 2
+        lat = (points[:, 1].min() + points[:, 1].max()) / 2
+        if name.upper() == 'GK':
+            return cls(f'EPSG:{GK_EPSG_BASE + gaussKrugerZone(lon)}')
+        base = UTM_NORTH_EPSG_BASE if lat >= 0 else UTM_SOUTH_EPSG_BASE
+        return cls(f'EPSG:{base + utmZone(lon)}')
+
+
+    def project(self, lon, lat):
+        """
+        Plane coordinates x, y of arrays of longitude and latitude
+        """
+        x, y = getTransformer(WGS84, self.crs).transform(lon, lat)
+        return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+
+    def projectTracks(self, tracks):
+        """
+        Project list of WGS84 tracks (N, 2) in one call, returns list of (N, 2) arrays of x, y
+        """
+        tracks = [np.asarray(track, dtype=np.float64).reshape(-1, 2) for track in tracks]
+        if not tracks:
+            return []
+        points = np.concatenate(tracks)
+        x, y = self.project(points[:, 0], points[:, 1])
+        return np.split(np.column_stack((x, y)), np.cumsum([len(track) for track in tracks])[:-1])
+
+
+    def __str__(self):
+        return self.crs
@@ -3,13 +3,20 @@ Module to read and write to settings file
 """
 
 SETTINGS_FILE = 'settings.cfg'
+# Kinds of mosaic canvas, see MapDrawer
+CANVAS_KINDS = ('dense', 'tiled', 'disk')
+# Ways to draw line on mosaic: rotated stripes or inverse mapping of map pixels, see LineRenderer
+RENDERERS = ('stripes', 'inverse')
 
 class Settings:
 
     def __init__(self):
         self.keys = ['directory', 'mapscale', 'cableout', 'margins',
                      'gamma', 'corwindow', 'slantthreshold', 'startsearchbottom', 'stripescale',
-                     'debug', 'correct_slantrange', 'corsltrg_searchwindow', 'corcltrg_frst_refl_bias']
+                     'debug', 'correct_slantrange', 'corsltrg_searchwindow', 'corcltrg_frst_refl_bias',
+                     'workers', 'channels', 'start_time', 'end_time', 'cache_size',
+                     'projection', 'export_csv', 'canvas', 'tile_memory', 'colormap',
+                     'renderer']
         self.directory = ''
         self.map_scale = 1.0
         self.cable_out = 0
@@ -23,6 +30,19 @@ class Settings:
         self.correct_slantrange = False
         self.corsltrng_searchwindow = 51
         self.corsltrng_frst_refl_bias = 0
+        self.workers = 0 # Number of processes, 0 for all CPU cores
+        self.channels = (0, 1) # Port and starboard channels in XTF ping
+        # Part of XTF files to process, seconds of day (UTC as in XTF), None - from start / to end
+        self.start_time = None
+        self.end_time = None
+        self.cache_size = 2048 # Size limit of stage cache in proc folder, MB, 0 - no cache
+        self.projection = 'GK' # GK or UTM zone chosen for the whole survey, or EPSG:<code>
+        self.export_csv = False # Write tracks to Surfer CSV files besides binary track files
+        self.canvas = 'tiled' # dense - one array over bounding box of track, tiled - tiles under stripes only,
+                              # disk - tiles in folder on disk
+        self.tile_memory = 1024 # Memory for tiles of disk canvas, MB (the rest of tiles is on disk)
+        self.colormap = '' # Matplotlib colormap for RGB mosaic, empty - grayscale mosaic
+        self.renderer = 'stripes' # stripes - rotated stripes, inverse - source ping and sample of every map pixel
         try:
             self.readfile()
         except FileNotFoundError:
@@ -42,7 +62,18 @@ class Settings:
                 f'{self.keys[9]}:{self.debug}\n' + \
                 f'{self.keys[10]}:{self.correct_slantrange}\n' + \
                 f'{self.keys[11]}:{self.corsltrng_searchwindow}\n' + \
-                f'{self.keys[12]}:{self.corsltrng_frst_refl_bias}\n'
+                f'{self.keys[12]}:{self.corsltrng_frst_refl_bias}\n' + \
+                f'{self.keys[13]}:{self.workers}\n' + \
+                f'{self.keys[14]}:{self.channels[0]},{self.channels[1]}\n' + \
+                f'{self.keys[15]}:{self._formatDayTime(self.start_time)}\n' + \
+                f'{self.keys[16]}:{self._formatDayTime(self.end_time)}\n' + \
+                f'{self.keys[17]}:{self.cache_size}\n' + \
+                f'{self.keys[18]}:{self.projection}\n' + \
+                f'{self.keys[19]}:{self.export_csv}\n' + \
+                f'{self.keys[20]}:{self.canvas}\n' + \
+                f'{self.keys[21]}:{self.tile_memory}\n' + \
+                f'{self.keys[22]}:{self.colormap}\n' + \
+                f'{self.keys[23]}:{self.renderer}\n'
 
 
 
@@ -59,7 +90,18 @@ class Settings:
                 self.keys[9]:self.debug,
                 self.keys[10]:self.correct_slantrange,
                 self.keys[11]:self.corsltrng_searchwindow,
-                self.keys[12]:self.corsltrng_frst_refl_bias}
+                self.keys[12]:self.corsltrng_frst_refl_bias,
+                self.keys[13]:self.workers,
+                self.keys[14]:f'{self.channels[0]},{self.channels[1]}',
+                self.keys[15]:self._formatDayTime(self.start_time),
+                self.keys[16]:self._formatDayTime(self.end_time),
+                self.keys[17]:self.cache_size,
+                self.keys[18]:self.projection,
+                self.keys[19]:self.export_csv,
+                self.keys[20]:self.canvas,
+                self.keys[21]:self.tile_memory,
+                self.keys[22]:self.colormap,
+                self.keys[23]:self.renderer}
         return self.settings_dict
     
     def updateSettingsFromUI(self, settings_dict : dict):
@@ -106,52 +148,179 @@ class Settings:
                 self.corsltrng_searchwindow = int(settings_dict[dict_key])
             if self.keys[12]  ==  dict_key:
                 self.corsltrng_frst_refl_bias = int(settings_dict[dict_key])
+            if self.keys[13]  ==  dict_key:
+                self.workers = max(int(settings_dict[dict_key]), 0)
+            if self.keys[14]  ==  dict_key:
+                self.channels = self._parseChannels(settings_dict[dict_key])
+            if self.keys[15]  ==  dict_key:
+                self.start_time = self._parseDayTime(settings_dict[dict_key])
+            if self.keys[16]  ==  dict_key:
+                self.end_time = self._parseDayTime(settings_dict[dict_key])
+            if self.keys[17]  ==  dict_key:
+                self.cache_size = max(int(settings_dict[dict_key]), 0)
+            if self.keys[18]  ==  dict_key:
+                self.projection = self._parseProjection(settings_dict[dict_key])
+            if self.keys[19]  ==  dict_key:
+                self.export_csv = int(settings_dict[dict_key])
+            if self.keys[20]  ==  dict_key:
+                self.canvas = self._parseCanvas(settings_dict[dict_key])
+            if self.keys[21]  ==  dict_key:
+                self.tile_memory = max(int(settings_dict[dict_key]), 1)
+            if self.keys[22]  ==  dict_key:
+                self.colormap = self._parseColormap(settings_dict[dict_key])
+            if self.keys[23]  ==  dict_key:
+                self.renderer = self._parseRenderer(settings_dict[dict_key])
+
+    @staticmethod
+    def _parseChannels(text):
+        """
+        Port and starboard channel numbers from text like '0,1'
+        """
+        channels = tuple(int(x) for x in text.split(','))
+        if len(channels) != 2 or min(channels) < 0 or channels[0] == channels[1]:
+            raise ValueError(f'Wrong sonar channels: {text.strip()}')
+        return channels
+
+    @staticmethod
+    def _parseProjection(text):
+        """
+        GK, UTM or coordinate system name like EPSG:32637
+        """
+        text = text.strip()
+        if text.upper() in ('GK', 'UTM', ''):
+            return text.upper() or 'GK'
+        return text
+
+    @staticmethod
+    def _parseCanvas(text):
+        text = text.strip().lower() or 'tiled'
+        if text not in CANVAS_KINDS:
+            raise ValueError(f'Wrong canvas: {text}, one of {", ".join(CANVAS_KINDS)} expected')
+        return text
+
+    @staticmethod
+    def _parseRenderer(text):
+        text = text.strip().lower() or 'stripes'
+        if text not in RENDERERS:
+            raise ValueError(f'Wrong renderer: {text}, one of {", ".join(RENDERERS)} expected')
+        return text
+
+    @staticmethod
+    def _parseColormap(text):
+        """
+        Name of matplotlib colormap, empty for grayscale mosaic
+        """
+        text = text.strip()
+        return '' if text.lower() in ('', 'gray', 'grey') else text
+
+    @staticmethod
+    def _parseDayTime(text):
+        """
+        Seconds of day from text 'HH:MM:SS', None for empty text
+        """
+        text = text.strip()
+        if not text:
+            return None
+        parts = [float(x) for x in text.split(':')]
+        if len(parts) != 3 or not (0 <= parts[0] < 24 and 0 <= parts[1] < 60 and 0 <= parts[2] < 60):
+            raise ValueError(f'Wrong time of day: {text}, HH:MM:SS expected')
+        return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+    @staticmethod
+    def _formatDayTime(seconds):
+        if seconds is None:
+            return ''
+        seconds = int(seconds)
+        return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+    def time_window(self):
+        """
+        (start, end) seconds of day to process, None if whole files are processed
+        """
+        if self.start_time is None and self.end_time is None:
+            return None
+        return (self.start_time, self.end_time)
+
+    def subset_name(self):
+        """
+        Suffix of output files names when only part of XTF files is processed
+        """
+        if self.time_window() is None:
+            return ''
+        start = self._formatDayTime(self.start_time).replace(':', '') or 'start'
+        end = self._formatDayTime(self.end_time).replace(':', '') or 'end'
+        return f'_{start}-{end}'
 
     def readfile(self):
         with open(SETTINGS_FILE, 'r') as sett_read:
             for line in sett_read:
+                # Whole key is compared, so values like paths containing other keys are not parsed
+                key, _, value = line.partition(':')
+                key = key.strip()
                 # Path
-                if self.keys[0] in line:
-                    self.directory = ':'.join(line.split(':')[1:]).rstrip()
+                if self.keys[0] == key:
+                    self.directory = value.rstrip()
                 # Map Scale
-                if self.keys[1] in line:
-                    self.map_scale = float(line.split(':')[1])
+                if self.keys[1] == key:
+                    self.map_scale = float(value)
                 # Cable Out
-                if self.keys[2] in line:
-                    cable_out = int(line.split(':')[1])
+                if self.keys[2] == key:
+                    cable_out = int(value)
                     if cable_out < 0:
                         self.cable_out = None
                     else:
                         self.cable_out = cable_out
                 # Margins
-                if self.keys[3] in line:
-                    self.map_margins = int(line.split(':')[1])
+                if self.keys[3] == key:
+                    self.map_margins = int(value)
                 # Gamma
-                if self.keys[4] in line:
-                    self.gamma = float(line.split(':')[1])
+                if self.keys[4] == key:
+                    self.gamma = float(value)
                 # Correction window
-                if self.keys[5] in line:
-                    corwindow = int(line.split(':')[1])
+                if self.keys[5] == key:
+                    corwindow = int(value)
                     self.corwindow = corwindow if corwindow%2 == 1 else corwindow + 1
                 # Slant range threshold
-                if self.keys[6] in line:
-                    self.slantthreshold = int(line.split(':')[1])
+                if self.keys[6] == key:
+                    self.slantthreshold = int(value)
                 # Start search bottom
-                if self.keys[7] in line:
-                    self.startsearchbottom = int(line.split(':')[1])
+                if self.keys[7] == key:
+                    self.startsearchbottom = int(value)
                 # Stripe scale
-                if self.keys[8] in line:
-                    self.stripescale = int(line.split(':')[1])
+                if self.keys[8] == key:
+                    self.stripescale = int(value)
                                     # Stripe scale
-                if self.keys[9] in line:
-                    self.debug = int(line.split(':')[1])
+                if self.keys[9] == key:
+                    self.debug = int(value)
 
-                if self.keys[10] in line:
-                    self.correct_slantrange = int(line.split(':')[1])
-                if self.keys[11] in line:
-                    self.corsltrng_searchwindow = int(line.split(':')[1])
-                if self.keys[12] in line:
-                    self.corsltrng_frst_refl_bias = int(line.split(':')[1])
+                if self.keys[10] == key:
+                    self.correct_slantrange = int(value)
+                if self.keys[11] == key:
+                    self.corsltrng_searchwindow = int(value)
+                if self.keys[12] == key:
+                    self.corsltrng_frst_refl_bias = int(value)
+                if self.keys[13] == key:
+                    self.workers = max(int(value), 0)
+                if self.keys[14] == key:
+                    self.channels = self._parseChannels(value)
+                if self.keys[15] == key:
+                    self.start_time = self._parseDayTime(value)
+                if self.keys[16] == key:
+                    self.end_time = self._parseDayTime(value)
+                if self.keys[17] == key:
+                    self.cache_size = max(int(value), 0)
+                if self.keys[18] == key:
+                    self.projection = self._parseProjection(value)
+                if self.keys[19] == key:
+                    self.export_csv = int(value)
+                if self.keys[20] == key:
+                    self.canvas = self._parseCanvas(value)
+                if self.keys[21] == key:
+                    self.tile_memory = max(int(value), 1)
+                if self.keys[22] == key:
+                    self.colormap = self._parseColormap(value)
+                if self.keys[23] == key:
+                    self.renderer = self._parseRenderer(value)
 
     def writefile(self):
         if self.cable_out is None:
@@ -172,4 +341,15 @@ class Settings:
             sett_write.write(f'{self.keys[9]}:{self.debug:.0f}\n')
             sett_write.write(f'{self.keys[10]}:{self.correct_slantrange:.0f}\n')
             sett_write.write(f'{self.keys[11]}:{self.corsltrng_searchwindow:.0f}\n')
-            sett_write.write(f'{self.keys[12]}:{self.corsltrng_frst_refl_bias:.0f}\n')
\ No newline at end of file
+            sett_write.write(f'{self.keys[12]}:{self.corsltrng_frst_refl_bias:.0f}\n')
+            sett_write.write(f'{self.keys[13]}:{self.workers:.0f}\n')
+            sett_write.write(f'{self.keys[14]}:{self.channels[0]},{self.channels[1]}\n')
+            sett_write.write(f'{self.keys[15]}:{self._formatDayTime(self.start_time)}\n')
+            sett_write.write(f'{self.keys[16]}:{self._formatDayTime(self.end_time)}\n')
+            sett_write.write(f'{self.keys[17]}:{self.cache_size:.0f}\n')
+            sett_write.write(f'{self.keys[18]}:{self.projection}\n')
+            sett_write.write(f'{self.keys[19]}:{self.export_csv:.0f}\n')
+            sett_write.write(f'{self.keys[20]}:{self.canvas}\n')
+            sett_write.write(f'{self.keys[21]}:{self.tile_memory:.0f}\n')
+            sett_write.write(f'{self.keys[22]}:{self.colormap}\n')
+            sett_write.write(f'{self.keys[23]}:{self.renderer}\n')
\ No newline at end of file
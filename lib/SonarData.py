@@ -1,14 +1,25 @@
-import pyxtf
 import cv2
 import numpy as np
 import lib.Utils as ut
+from lib.dtypes import PING_TABLE_DTYPE
+from lib.io import saveNpy
+from lib.XTFReader import XTFReader, DEFAULT_CHANNELS, decodePingsShared
+from lib.BottomDetect import stepResponse, bottomResponse, detectFirstReflectionsGrouped, \
+                             detectFirstReflectionsShared, fillFromPrevious
+from lib.Parallel import SharedArray, workersCount, pingChunks
+from lib.GroundRange import REMAP_BLOCK_PINGS, fishHeights, imageGroundRange, groundRangeMap, remapRows
+from concurrent.futures import ProcessPoolExecutor
 import logging
 import glob
 from matplotlib import pyplot as plt
-import sys
-from scipy.signal import medfilt
 from scipy.optimize import minimize
 
+# Number of pings stacked into one 2D array for bottom detection
+BOTTOM_CHUNK_PINGS = 2048
+# Waterfall is decoded in worker processes only if each of them gets this many pings,
+# for smaller files pool startup takes longer than decoding
+DECODE_PINGS_PER_WORKER = 20000
+
 
 
 class SonarStripe:
@@ -32,20 +43,26 @@ class SonarStripe:
 class SonarData:
 
     def getPingTime(self, ping_no):
-        year = self.sonar_packets[ping_no].Year
-        month = self.sonar_packets[ping_no].Month + 1 # Month in XTF starts from 0
-        day =  self.sonar_packets[ping_no].Day
-        hour =  self.sonar_packets[ping_no].Hour
-        minute =  self.sonar_packets[ping_no].Minute
-        second =  self.sonar_packets[ping_no].Second
-        hseconds =  self.sonar_packets[ping_no].HSeconds # Hundredths of second
-        return np.array((year, month, day, hour, minute, second, hseconds), dtype=np.uint32)
+        ping = self.ping_table[ping_no]
+        return np.array((ping['year'],
+                         ping['month'] + 1, # Month in XTF starts from 0
+                         ping['day'],
+                         ping['hour'],
+                         ping['minute'],
+                         ping['second'],
+                         ping['hseconds']), dtype=np.uint32)
     
     
     def getSonarLine(self, ping_no):
+        """
+        Left and right channel of ping. Samples are read-only views into file
+        unless the line was replaced with writeSonarLine
+        """
         if 0 <= ping_no < self.pings_num:
-            l_chan = self.sonar_packets[ping_no].data[0]
-            r_chan = self.sonar_packets[ping_no].data[1]
+            if ping_no in self._written_lines:
+                return self._written_lines[ping_no]
+            l_chan = self.reader.channel(ping_no, 0)
+            r_chan = self.reader.channel(ping_no, 1)
             return (l_chan, r_chan)
         else:
             return None
@@ -53,48 +70,58 @@ class SonarData:
 
     def writeSonarLine(self, ping_no, rgt, lft):
         if 0 <= ping_no < self.pings_num:
-            self.sonar_packets[ping_no].data[0] = lft
-            self.sonar_packets[ping_no].data[1] = rgt 
+            self._written_lines[ping_no] = (lft, rgt)
+            self._invalidateImage()
 
 
     def getPingCoordinates(self, ping_no):
-        lon = self.sonar_packets[ping_no].ShipXcoordinate
-        lat = self.sonar_packets[ping_no].ShipYcoordinate
+        lon = self.ping_table['ship_x'][ping_no]
+        lat = self.ping_table['ship_y'][ping_no]
         return (lon, lat)
 
 
     def getPingCoordinatesGK(self, ping_no):
-        lon = self.sonar_packets[ping_no].ShipXcoordinateGK
-        lat = self.sonar_packets[ping_no].ShipYcoordinateGK
+        lon = self.ping_table['gk_x'][ping_no]
+        lat = self.ping_table['gk_y'][ping_no]
         return (lon, lat)
 
 
     def getPingNoByTime(self, input_time, start_no=0, reversed = False):
+        """
+        Number of first ping after input_time (year, month, day, hour, minute, second, hseconds)
+        starting from start_no. If reversed, number of last ping before input_time,
+        searching back from start_no
+        """
+        return int(self.getPingNosByTime([input_time], start_no, reversed)[0])
+
+
+    def getPingNosByTime(self, input_times, start_no=0, reversed = False):
+        """
+        Batch version of getPingNoByTime.
+        input_times is array of shape (N, 7) in the same format as getPingTime output,
+        returns array of N ping numbers
+        """
+        input_times = np.atleast_2d(np.asarray(input_times))
+        input_sec = self._unwrapQueryTimes(ut.timeToEpoch(*input_times.transpose()))
         if reversed:
-            for packet_no in range(start_no, 0, -1):
-                cur_packet_time = self.getPingTime(packet_no)
-                if ut.timeToSec(*cur_packet_time) < ut.timeToSec(*input_time):
-                    break
-            return packet_no
+            ping_nos = np.searchsorted(self.time_index, input_sec, side='left') - 1
+            return np.minimum(np.maximum(ping_nos, 1), start_no)
 
-        for packet_no in range(start_no, self.pings_num):
-            cur_packet_time = self.getPingTime(packet_no)
-            if ut.timeToSec(*cur_packet_time) > ut.timeToSec(*input_time):
-                break
-        return packet_no
+        ping_nos = np.searchsorted(self.time_index, input_sec, side='right')
+        return np.minimum(np.maximum(ping_nos, start_no), self.pings_num - 1)
 
 
     def createFrame(self, ping_no, vertical_scale):
         ping_no = self.pings_num - ping_no # Because full picture starts with end
         # Check if frame doesn't exceed beginning and ending of data
-        if vertical_scale >= len(self.sonar_packets):
+        if vertical_scale >= self.pings_num:
             begin = 0
             end = self.pings_num
         else:
             if ping_no > vertical_scale//2:
-                if ping_no > len(self.sonar_packets) - vertical_scale/2:
+                if ping_no > self.pings_num - vertical_scale/2:
                     begin = ping_no - vertical_scale//2
-                    end = len(self.sonar_packets) - 1
+                    end = self.pings_num - 1
                 else:
                     begin = ping_no - vertical_scale//2
                     end = ping_no + vertical_scale//2
@@ -128,32 +155,42 @@ class SonarData:
 
         # Calculate size in meters
 
-        Xsize = self.sonar_packets[ping_start].ping_chan_headers[0].SlantRange + \
-                 self.sonar_packets[ping_start].ping_chan_headers[1].SlantRange 
+        if self.ground_range is None:
+            Xsize = float(np.sum(self.ping_table['slant_range'][ping_start], dtype=np.float64))
+        else:
+            Xsize = 2 * self.ground_range
         Ysize = ut.calcDistance((lon1, lat1), (lon2, lat2))
 
         return SonarStripe(img, (lon1, lat1), (Xsize, Ysize))
     
 
+    def getStripePings(self):
+        """
+        First pings and stops of stripes: runs of pings with equal GK coordinates
+        """
+        lon = self.ping_table['gk_x']
+        lat = self.ping_table['gk_y']
+        # Pings where coordinate differs from previous one
+        ping_stops = np.flatnonzero((lon[1:] != lon[:-1]) | (lat[1:] != lat[:-1])) + 1
+        ping_starts = np.concatenate(([0], ping_stops[:-1]))
+        return ping_starts, ping_stops
+
+
+    def getSwathWidths(self) -> np.ndarray:
+        """
+        Width of swath of every ping in meters, as width of stripes (see getSonarStripeGK)
+        """
+        if self.ground_range is None:
+            return self.ping_table['slant_range'].astype(np.float64).sum(axis=1)
+        return np.full(self.pings_num, 2 * self.ground_range, dtype=np.float64)
+
+
     def splitIntoGKStripes(self):
         # Split sonar image in stripes with equal coordinates 
         # Also form filtered track
-        sonar_stripes = []
-        ping_start = 0
-        ping_no = 0
-        prev_lon = self.sonar_packets[0].ShipXcoordinateGK
-        prev_lat = self.sonar_packets[0].ShipYcoordinateGK
-        for sonar_packet in self.sonar_packets[1:]:
-            ping_no += 1
-            lon = sonar_packet.ShipXcoordinateGK
-            lat = sonar_packet.ShipYcoordinateGK
-            ping_stop = ping_no
-            if prev_lon != lon or prev_lat != lat:
-                stripe = self.getSonarStripeGK(ping_start, ping_stop)
-                sonar_stripes.append(stripe)
-                ping_start = ping_stop
-                prev_lat = lat
-                prev_lon = lon
+        ping_starts, ping_stops = self.getStripePings()
+        sonar_stripes = [self.getSonarStripeGK(int(ping_start), int(ping_stop))
+                         for ping_start, ping_stop in zip(ping_starts, ping_stops)]
         print(f'Created {len(sonar_stripes)} sonar stripes')
         return sonar_stripes
     
@@ -167,180 +204,392 @@ class SonarData:
 
     
     def convolve(self, y_data, window_size):
-        if window_size % 2 == 0:
-            raise ValueError
-        half_window = (window_size-1)//2
-        window = np.ones((window_size))
-        window[half_window:] = window[half_window:] * (-1)
-        output = np.zeros((len(y_data)))
-        output[half_window : -half_window] = np.convolve(y_data, window, 'valid')
-        return output
+        return stepResponse(np.asarray(y_data)[np.newaxis, :], window_size)[0]
     
 
 
     def _estimateFirstReflection2(self, rgt, start_refl, window, frst_refl_bias):
-        # Remove last element because yellowfin has strange drop of data there
-        rgt_log = np.log(rgt[start_refl:] + 0.001).astype(np.float32)[:-10] 
-        rgt_fltrd = medfilt(rgt_log, 11)
-        rgt_deriv = np.gradient(rgt_fltrd, np.arange(len(rgt_log)))
-        rgt_proc = self.convolve(rgt_fltrd, window)
+        # Single ping version of _estimateFirstReflections, used to plot signal in debug mode
+        rgt_proc = bottomResponse(rgt[np.newaxis, :], start_refl, window)[0]
         first_refl = np.where(rgt_proc == np.max(rgt_proc))[0][0]
         return int(first_refl + start_refl + frst_refl_bias), rgt_proc
-    
 
-    def calculateNewDistances(self, rgt, slant_range, fish_height, first_reflection):
-        x0 = np.arange(len(rgt))
-        L = x0[first_reflection:] * slant_range / len(rgt) # array of slant ranges for each reflection
-        H = fish_height
-        return np.sqrt(L*L - H*H)
-    
-    
-    def remapChannel(self, rgt_corrected, new_range):
-        x0 = new_range
-        x1 = np.linspace(0, new_range[-1], len(new_range))
-        y_new = np.interp(x1, x0, rgt_corrected)
-        y_new[y_new < 1] = 1
-        return y_new
-    
 
-    def correctSlantRange(self, startrefl, debug, window_size, frst_refl_bias, store_file = None, data_provided=False):
+    def _stackChannel(self, channel, start, stop, reverse=False, out=None, align_end=False):
+        """
+        Samples of one channel for pings from start to stop as 2D array.
+        Shorter pings are padded with zeros at the end, or at the beginning if align_end.
+        If reverse, samples of each ping are inversed
+        """
+        lengths = self.ping_table['num_samples'][start:stop, channel]
+        if out is None:
+            out = np.zeros((stop - start, lengths.max()), dtype=self.reader.sample_dtypes[channel])
+        width = out.shape[1]
+        # Pings of equal length, equally spaced in file, are copied at once
+        rows = None if self._written_lines else self.reader.channelRows(channel, start, stop)
+        if rows is not None:
+            length = rows.shape[1]
+            out[:, width - length if align_end else 0:][:, :length] = rows[:, ::-1] if reverse else rows
+            return out
+        for ping_no, row in zip(range(start, stop), out):
+            data = self.getSonarLine(ping_no)[channel]
+            row[width - len(data) if align_end else 0:][:len(data)] = data[::-1] if reverse else data
+        return out
+
+
+    def _estimateFirstReflections(self, startrefl, window, frst_refl_bias, pool=None, shared_rgt=None, chunks=None):
+        """
+        Estimate first reflection by right channel for all pings.
+        Pings are stacked into 2D arrays by chunks and processed together,
+        in worker processes if pool is given (chunks of pings are ranges of shared_rgt rows).
+        If first reflection is not found, value of previous ping is used
+        """
+        rgt_lengths = self.ping_table['num_samples'][:, 1].astype(np.int64)
+        slant_ranges = self.ping_table['slant_range'][:, 0].astype(np.float64)
+        startrefl_pixels = (startrefl * rgt_lengths / slant_ranges).astype(int)
+
+        first_ref_arr = np.zeros(self.pings_num, dtype=int)
+        valid = np.zeros(self.pings_num, dtype=bool)
+        if pool is not None:
+            results = pool.map(detectFirstReflectionsShared,
+                               [shared_rgt.descriptor()] * len(chunks),
+                               [start for start, _ in chunks],
+                               [rgt_lengths[start:stop] for start, stop in chunks],
+                               [startrefl_pixels[start:stop] for start, stop in chunks],
+                               [window] * len(chunks),
+                               [frst_refl_bias] * len(chunks))
+            # Results come in order of chunks
+            for (start, stop), (chunk_refl, chunk_valid) in zip(chunks, results):
+                first_ref_arr[start:stop] = chunk_refl
+                valid[start:stop] = chunk_valid
+        else:
+            for start in range(0, self.pings_num, BOTTOM_CHUNK_PINGS):
+                stop = min(start + BOTTOM_CHUNK_PINGS, self.pings_num)
+                rgt_rows = self._stackChannel(1, start, stop)
+                first_ref_arr[start:stop], valid[start:stop] = \
+                    detectFirstReflectionsGrouped(rgt_rows, rgt_lengths[start:stop],
+                                                  startrefl_pixels[start:stop],
+                                                  window, frst_refl_bias)
+        print(f'First reflection found in {np.count_nonzero(valid)} of {self.pings_num} pings')
+        return fillFromPrevious(first_ref_arr, valid)
+
+
+    def correctSlantRange(self, startrefl, debug, window_size, frst_refl_bias, store_file = None, data_provided=False,
+                          workers=1):
+        """
+        Correct slant range of every ping using first reflection as fish height.
+        Full image is replaced with ground range image, sonar packets are not changed.
+        workers is number of processes for first reflection search (0 for all CPU cores),
+        in debug mode one is used
+        """
+        first_ref_arr = self._loadFirstReflections(store_file) if data_provided else None
+        # Processes and shared channel are created only when first reflections are estimated
+        if first_ref_arr is None:
+            workers = 1 if debug else workersCount(workers, self.pings_num)
+            if workers > 1:
+                chunks = pingChunks(self.pings_num, workers)
+                with ProcessPoolExecutor(max_workers=workers) as pool, \
+                     SharedArray(((self.pings_num, self.ping_table['num_samples'][:, 1].max())),
+                                 self.reader.sample_dtypes[1]) as shared_rgt:
+                    self._stackChannel(1, 0, self.pings_num, out=shared_rgt.array)
+                    first_ref_arr = self._estimateAndStoreFirstReflections(startrefl, window_size, frst_refl_bias,
+                                                                           store_file, pool, shared_rgt, chunks)
+            else:
+                first_ref_arr = self._estimateAndStoreFirstReflections(startrefl, window_size, frst_refl_bias,
+                                                                       store_file)
+        if debug:
+            self._showFirstReflections(startrefl, window_size, frst_refl_bias, first_ref_arr)
 
+        # +++++++++ ACTUAL CORRECTION ++++++++++++++++++++++++
+        lengths = self.ping_table['num_samples'].astype(np.int64)
+        slant_ranges = self.ping_table['slant_range'].astype(np.float64)
+        # Fish height is estimated by right channel
+        self._fish_heights = fishHeights(lengths[:, 1], slant_ranges[:, 1], np.asarray(first_ref_arr))
+        self.ground_range = max(imageGroundRange(lengths[:, 0], slant_ranges[:, 0], self._fish_heights),
+                                imageGroundRange(lengths[:, 1], slant_ranges[:, 1], self._fish_heights))
+        # Ground range image is built on next use of full image
+        self._preserve_alpha = False
+        self._invalidateImage()
         if debug:
-            fig, ax = plt.subplots(2, 1)
-            plt.show(block=False)
+            cv2.imshow('Ground range', ut.ratioPreservedResize(self.fullImage, (0,1000)))
+            cv2.waitKey(1)
+
+
+    def _showFirstReflections(self, startrefl, window_size, frst_refl_bias, first_ref_arr):
+        """
+        Debug view: signal of every ping and found first reflection
+        """
+        fig, ax = plt.subplots(1, 1)
+        plt.show(block=False)
 
+        # Prepare output img
+        slant_corr_img = np.zeros((self.pings_num, self.ping_table['num_samples'][:, 1].max(), 3)).astype(np.uint8)
+        resize_sc_img = ut.ratioPreservedResize(slant_corr_img, (0,1000))
+        cv2.imshow('Estimate reflection', resize_sc_img)
+        cv2.waitKey(1)
 
-            # Prepare output img
-            slant_corr_img = np.zeros((len(self.sonar_packets), len(self.getSonarLine(0)[1]), 3)).astype(np.uint8)
+        for ping_no, first_reflection in enumerate(first_ref_arr):
+            lft, rgt = self.getSonarLine(ping_no)
+            slant_range = float(self.ping_table['slant_range'][ping_no, 0])
+            startrefl_pixels = int(startrefl * len(rgt) / slant_range )
+            try:
+                _, plot_data = self._estimateFirstReflection2(rgt, startrefl_pixels, window_size, frst_refl_bias)
+                ax.clear()
+                ax.plot(plot_data)
+                # ax.axvline(x=first_reflection, color='red')
+                ax.set_title(f'Ping {ping_no}: log signal')
+                plt.draw()
+                plt.pause(0.001)
+            except (IndexError, ValueError):
+                pass
+
+            # Update output_img
+            row = slant_corr_img[ping_no, :len(rgt)]
+            for i in range(3): row[:, i] = rgt
+            cv2.circle(slant_corr_img, [int(first_reflection), ping_no], 3, [0,0,255])
             resize_sc_img = ut.ratioPreservedResize(slant_corr_img, (0,1000))
             cv2.imshow('Estimate reflection', resize_sc_img)
             cv2.waitKey(1)
 
-        # Initiate array
-        first_ref_arr = []
-
-        if not data_provided:
-            prev_first_reflection = 0
-
-            # Estimate if not estimated
-
-
-            for ping_no in range(len(self.sonar_packets)):
-                sys.stdout.write(f'\rAnalysing {ping_no} of {len(self.sonar_packets)} pings')
-                lft, rgt = self.getSonarLine(ping_no)
-                slant_range = self.sonar_packets[ping_no].ping_chan_headers[0].SlantRange
-                lft = lft[::-1] # Inverse to work nice
-                
-                startrefl_pixels = int(startrefl * len(rgt) / slant_range )
-                # print(f'start reflection: {startrefl_pixels}')
-                try:
-                    first_reflection, plot_data = self._estimateFirstReflection2(rgt, startrefl_pixels, window_size, frst_refl_bias)
-
-                    if debug:
-                        ax[0].clear()
-                        ax[0].plot(plot_data)
-                        # ax[0].axvline(x=first_reflection, color='red')
-                        ax[0].set_title(f'Ping {ping_no}: log signal')
-                        plt.draw()
-                        plt.pause(0.001)
-                except IndexError:
-                    first_reflection = prev_first_reflection
-                prev_first_reflection = first_reflection
-                fish_height = slant_range * first_reflection / len(rgt)
-
-
-                first_ref_arr.append(first_reflection)
-
-                if debug:
-                    # Update output_img
-                    for i in range(3): slant_corr_img[ping_no, :, i] = rgt
-                    cv2.circle(slant_corr_img, [first_reflection, ping_no], 3, [0,0,255])
-                    resize_sc_img = ut.ratioPreservedResize(slant_corr_img, (0,1000))
-                    cv2.imshow('Estimate reflection', resize_sc_img)
-                    cv2.waitKey(1)
-
-            # Store to file
-            if store_file is not None:
-                with open(store_file, 'w') as fwrite:
-                    for ping_no, first_reflection in enumerate(first_ref_arr):
-                        fwrite.write(f'{ping_no};{first_reflection}\n')          
 
-        else:
-            #  Load first reflections from file
-            with open(store_file, 'r') as fread:
-                for line in fread:
-                    _, first_reflection = line.split(';')
-                    first_ref_arr.append(int(first_reflection))
+    def _groundRangeImage(self):
+        """
+        Waterfall resampled to ground range, rows in the same order as in full image.
+        Pings are remapped by blocks with cv2.remap (see GroundRange module)
+        with fish heights and ground range found by slant range correction
+        """
+        table = self.ping_table
+        lengths = table['num_samples'].astype(np.int64)
+        slant_ranges = table['slant_range'].astype(np.float64)
+        heights = self._fish_heights
+        port_width, stbd_width = lengths.max(axis=0)
+        width = max(port_width, stbd_width)
+        weights = np.power(2.0, -table['weight'].astype(np.float64))
+
+        dtype = self._waterfallDtype()
+        image = np.zeros((self.pings_num, 2 * width), dtype=dtype)
+        for start in range(0, self.pings_num, REMAP_BLOCK_PINGS):
+            stop = min(start + REMAP_BLOCK_PINGS, self.pings_num)
+            src = np.zeros((stop - start, port_width + stbd_width), dtype=dtype)
+            self._stackChannel(0, start, stop, out=src[:, :port_width])
+            self._stackChannel(1, start, stop, out=src[:, port_width:])
+            map_x = groundRangeMap((lengths[start:stop, 0], slant_ranges[start:stop, 0], heights[start:stop]),
+                                   (lengths[start:stop, 1], slant_ranges[start:stop, 1], heights[start:stop]),
+                                   port_width, self.ground_range, width)
+            block = remapRows(src, map_x)
+            # Integer samples are truncated after weighting, as in pyxtf
+            np.multiply(block[:, :width], weights[start:stop, 0, np.newaxis], out=block[:, :width], casting='unsafe')
+            np.multiply(block[:, width:], weights[start:stop, 1, np.newaxis], out=block[:, width:], casting='unsafe')
+            # Full image starts with the last ping
+            image[self.pings_num - stop : self.pings_num - start] = block[::-1]
+        return image
+
+
+    def _loadFirstReflections(self, store_file):
+        """
+        First reflections from store_file (.npy), None if they don't match pings of file
+        """
+        first_ref_arr = np.load(store_file)
+        if first_ref_arr.shape == (self.pings_num,):
+            return first_ref_arr
+        logging.warning(f'{store_file} does not match pings of file, estimating again')
+        return None
 
-        # +++++++++ ACTUAL CORRECTION ++++++++++++++++++++++++
 
-        for ping_no, first_reflection in zip(range(len(self.sonar_packets)), first_ref_arr):
-            slant_range = self.sonar_packets[ping_no].ping_chan_headers[0].SlantRange
-            lft, rgt = self.getSonarLine(ping_no)
-            lft = lft[::-1] # Inverse to work nice
-            fish_height = slant_range * first_reflection / len(rgt)
-            new_ranges = self.calculateNewDistances(rgt, slant_range, fish_height, first_reflection)
-
-            if len(new_ranges) > 100:
-                new_rgt = self.remapChannel(rgt[first_reflection:], new_ranges)
-                new_lft = self.remapChannel(lft[first_reflection:], new_ranges)
-                new_lft = new_lft[::-1] # Inverse back
-                new_slant_range = new_ranges[-1]
-                if debug:
-                    # ax[1].plot(old_ranges, rgt, label='Raw')
-                    # ax[1].plot(new_ranges, rgt[first_reflection:], label='Corrected')
-                    # plt.draw()
-                    # new_slant_range = new_ranges[-1]
-                    ax[1].clear()
-                    ax[1].plot(new_rgt)
-                    ax[1].set_title('Updated signal')
-                    plt.draw()
-
-                # Update slant ranges
-                self.sonar_packets[ping_no].ping_chan_headers[0].NumSamples = len(new_ranges)
-                self.sonar_packets[ping_no].ping_chan_headers[1].NumSamples = len(new_ranges)
-
-                self.sonar_packets[ping_no].ping_chan_headers[0].SlantRange = new_slant_range
-                self.sonar_packets[ping_no].ping_chan_headers[1].SlantRange = new_slant_range
-                self.writeSonarLine(ping_no, new_rgt, new_lft)
-        self.generateFullImage(preserve_alpha=False)
-
-            
+    def _estimateAndStoreFirstReflections(self, startrefl, window_size, frst_refl_bias,
+                                          store_file, pool=None, shared_rgt=None, chunks=None):
+        """
+        Estimate first reflections and store them to store_file (.npy)
+        """
+        first_ref_arr = self._estimateFirstReflections(startrefl, window_size, frst_refl_bias,
+                                                       pool, shared_rgt, chunks).astype(np.int32)
+        if store_file is not None:
+            saveNpy(store_file, first_ref_arr)
+        return first_ref_arr
 
 
-    def generateFullImage(self, preserve_alpha = True):
-        np_chan1 = pyxtf.concatenate_channel(self.sonar_packets,
-                                             file_header=self.file_header, channel=0, weighted=True)
-        np_chan2 = pyxtf.concatenate_channel(self.sonar_packets,
-                                             file_header=self.file_header, channel=1, weighted=True)
+    @property
+    def fullImage(self):
+        """
+        Waterfall image of all pings, row 0 is the last ping.
+        Built on first use, rebuilt only after changes of ping data or image parameters.
+        float32 image from 0 to 1, or uint8 if gamma correction is set
+        """
+        if self._full_image is None:
+            dtype = np.float32 if self.gamma is None else np.uint8
+            self._full_image = self.getImage(dtype, gamma=self.gamma)
+        return self._full_image
+
 
-        fullImage = np.concatenate((np_chan1, np_chan2), axis=1)
-        self.fullImage = (fullImage - np.amin(fullImage)) / (np.amax(fullImage) - np.amin(fullImage))
+    def getImage(self, dtype=np.float32, preserve_alpha=None, gamma=None):
+        """
+        Waterfall scaled to range from 0 to 1 for float dtype, or to full range of integer dtype.
+        If preserve_alpha, values are not less than 1/255, so only padding becomes transparent.
+        By default it's done for slant range image only.
+        Gamma correction is applied if gamma is given.
+        For 8 and 16 bit waterfall scaling and gamma are one lookup table built from histogram
+        """
+        waterfall = self._getWaterfall()
+        if preserve_alpha is None:
+            preserve_alpha = self._preserve_alpha
+        if waterfall.dtype.kind == 'u':
+            if self._histogram is None:
+                self._histogram = ut.imageHistogram(waterfall)
+            return ut.applyLut(waterfall, ut.levelsLut(self._histogram, dtype, preserve_alpha, gamma))
+
+        # Other sample formats are stored as float32
+        dtype = np.dtype(dtype)
+        low = np.amin(waterfall)
+        high = np.amax(waterfall)
+        image = np.subtract(waterfall, low, dtype=dtype if dtype.kind == 'f' else np.float32)
+        if high > low:
+            image /= high - low
         if preserve_alpha:
-            self.fullImage[self.fullImage < 1/255] = 1/255
-        # self.rawImage = np.copy(self.fullImage)
+            np.maximum(image, 1/255, out=image)
+        if gamma is not None:
+            np.power(image, 1/gamma, out=image)
+        if dtype.kind != 'f':
+            image *= np.iinfo(dtype).max
+            image = image.astype(dtype)
+        return image
+
 
+    def _waterfallDtype(self):
+        """
+        8 and 16 bit samples are stored as they are, others as float32
+        """
+        dtype = self.reader.sample_dtypes[1]
+        if dtype in (np.uint8, np.uint16):
+            return dtype
+        return np.dtype(np.float32)
+
+
+    def _getWaterfall(self):
+        """
+        Not normalized waterfall: ground range image after slant range correction,
+        otherwise pings as they are in file
+        """
+        if self._waterfall is None:
+            if self._fish_heights is not None:
+                self._waterfall = self._groundRangeImage()
+            else:
+                self._waterfall = self._slantRangeImage()
+        return self._waterfall
+
+
+    def getWaterfall(self):
+        """
+        Not normalized waterfall, e.g. to store it and pass to setWaterfall later
+        """
+        return self._getWaterfall()
+
+
+    def setWaterfall(self, waterfall, ground_range=None):
+        """
+        Use waterfall built before instead of building it from pings.
+        ground_range in meters is given for ground range waterfall
+        """
+        self._invalidateImage()
+        self._waterfall = waterfall
+        self.ground_range = ground_range
+        self._preserve_alpha = ground_range is None
+
+
+    def _slantRangeImage(self):
+        """
+        Pings as they are in file, rows in the same order as in full image.
+        Port channel is padded at the beginning, starboard at the end
+        and samples are weighted as in pyxtf.concatenate_channel
+        """
+        lengths = self.ping_table['num_samples']
+        port_width, stbd_width = lengths.max(axis=0)
+        shape = (self.pings_num, port_width + stbd_width)
+        # Replaced lines are not in file, so such data is decoded here
+        workers = 1 if self._written_lines else \
+                  workersCount(self.workers, self.pings_num, DECODE_PINGS_PER_WORKER)
+        if workers > 1:
+            image = self._decodeParallel(shape, port_width, workers)
+        else:
+            image = np.zeros(shape, dtype=self._waterfallDtype())
+            # Full image starts with the last ping
+            self._stackChannel(0, 0, self.pings_num, out=image[::-1, :port_width], align_end=True)
+            self._stackChannel(1, 0, self.pings_num, out=image[::-1, port_width:])
+
+        weights = self.ping_table['weight'][::-1]
+        for channel, columns in enumerate((slice(0, port_width), slice(port_width, None))):
+            rows = np.flatnonzero(weights[:, channel])
+            if len(rows):
+                factors = np.power(2.0, -weights[rows, channel].astype(np.float64))[:, np.newaxis]
+                image[rows, columns] = (image[rows, columns] * factors).astype(image.dtype)
+        return image
+
+
+    def _decodeParallel(self, shape, port_width, workers):
+        """
+        Slant range image decoded by ranges of pings in worker processes.
+        Each worker reads the file itself and writes its rows into shared image
+        """
+        chunks = pingChunks(self.pings_num, workers)
+        # Full image starts with the last ping, so rows of chunk are reversed
+        first_rows = [self.pings_num - stop for _, stop in chunks]
+        data_offsets = [self.reader.data_offsets[start:stop][::-1] for start, stop in chunks]
+        num_samples = [self.reader.num_samples[start:stop][::-1] for start, stop in chunks]
+        sample_dtypes = [dtype.str for dtype in self.reader.sample_dtypes]
+        with ProcessPoolExecutor(max_workers=workers) as pool, \
+             SharedArray(shape, self._waterfallDtype()) as shared_image:
+            list(pool.map(decodePingsShared,
+                          [self.reader.xtf_file] * len(chunks),
+                          [shared_image.descriptor()] * len(chunks),
+                          first_rows, data_offsets, num_samples,
+                          [sample_dtypes] * len(chunks),
+                          [port_width] * len(chunks)))
+            return shared_image.array.copy()
+
+
+    def _invalidateImage(self):
+        """
+        Ping data changed, image is rebuilt on next use
+        """
+        self._waterfall = None
+        self._histogram = None
+        self._full_image = None
+
+
+    def generateFullImage(self, preserve_alpha = True):
+        """
+        Normalized full image without gamma correction
+        """
+        self._preserve_alpha = preserve_alpha
+        self.gamma = None
+        self._full_image = None
         return self.fullImage
 
 
     def gammaCorrect(self, gamma):
-        self.fullImage = ut.gammaCorrection(self.fullImage, gamma)
+        """
+        Set gamma correction of full image. It's applied to normalized waterfall,
+        so repeated calls don't accumulate
+        """
+        self.gamma = gamma
+        self._full_image = None
 
 
     def extractCableOut(self):
-        return [self.sonar_packets[i].CableOut
-                              for i in range(self.pings_num)]
+        return self.ping_table['cable_out']
 
 
     def extractTrackWGS84(self) -> np.ndarray:
         """
         Extracts track coordinates for each ping as np array
         """
-        y = [self.sonar_packets[i].ShipYcoordinate
-                              for i in range(self.pings_num)]
-        x = [self.sonar_packets[i].ShipXcoordinate
-                              for i in range(self.pings_num)]
-        return np.array((x,y)).transpose()
+        return np.column_stack((self.ping_table['ship_x'], self.ping_table['ship_y']))
+
+
+    def extractPingTimes(self) -> np.ndarray:
+        """
+        Time of each ping, seconds since epoch
+        """
+        return self.ping_table['time'].copy()
     
 
     def loadGK(self, coord_array : np.ndarray):
@@ -350,66 +599,133 @@ class SonarData:
         """
         x_arr, y_arr = coord_array.transpose()
         if len(x_arr) + len(y_arr) != self.pings_num * 2:
-            logging.log('Dimension of GK data is wrong')
+            logging.error('Dimension of GK data is wrong')
             return 0
-        for i, x, y in zip(range(len(x_arr)), x_arr, y_arr):
-            self.sonar_packets[i].ShipYcoordinateGK = y
-            self.sonar_packets[i].ShipXcoordinateGK = x
+        self.ping_table['gk_x'] = x_arr
+        self.ping_table['gk_y'] = y_arr
 
     def getXYT(self):
         """
         Return array of X Y and time as text
         """
-        out_array = []
-        for ping_no in range(self.pings_num):
-            x = self.sonar_packets[ping_no].ShipXcoordinate
-            y = self.sonar_packets[ping_no].ShipYcoordinate
-            year = self.sonar_packets[ping_no].Year
-            month = self.sonar_packets[ping_no].Month # Month in XTF starts from 0
-            day =  self.sonar_packets[ping_no].Day
-            hour =  self.sonar_packets[ping_no].Hour
-            minute =  self.sonar_packets[ping_no].Minute
-            second =  self.sonar_packets[ping_no].Second
-            out_array.append(f'{year}/{month}/{day} {hour}:{minute}:{second};{x},{y}')
-        return out_array
-    
-
+        table = self.ping_table
+        columns = (table['year'].tolist(),
+                   table['month'].tolist(), # Month in XTF starts from 0
+                   table['day'].tolist(),
+                   table['hour'].tolist(),
+                   table['minute'].tolist(),
+                   table['second'].tolist(),
+                   table['ship_x'].tolist(),
+                   table['ship_y'].tolist())
+        return [f'{year}/{month}/{day} {hour}:{minute}:{second};{x},{y}'
+                for year, month, day, hour, minute, second, x, y in zip(*columns)]
+
+
+    def _buildPingTable(self):
+        """
+        Header values of every sonar ping in numpy structured array (see dtypes.PING_TABLE_DTYPE)
+        """
+        headers = self.reader.ping_headers
+        chan_headers = self.reader.chan_headers
+        table = np.zeros(self.pings_num, dtype=PING_TABLE_DTYPE)
+        for column, field in (('year', 'Year'), ('month', 'Month'), ('day', 'Day'),
+                              ('hour', 'Hour'), ('minute', 'Minute'), ('second', 'Second'),
+                              ('hseconds', 'HSeconds'),
+                              ('ship_x', 'ShipXcoordinate'), ('ship_y', 'ShipYcoordinate'),
+                              ('sensor_x', 'SensorXcoordinate'), ('sensor_y', 'SensorYcoordinate'),
+                              ('cable_out', 'CableOut'), ('altitude', 'SensorPrimaryAltitude'),
+                              ('heading', 'SensorHeading')):
+            table[column] = headers[field]
+        table['gk_x'] = np.nan
+        table['gk_y'] = np.nan
+        table['slant_range'] = chan_headers['SlantRange']
+        table['num_samples'] = self.reader.num_samples
+        table['weight'] = chan_headers['Weight']
+        return table
+
+
+    def _reconstructTime(self):
+        """
+        Update HSeconds parameter (hundredths of second), because it's always zero
+        in our Videomodule XTF files: pings are spread evenly inside every second.
+        Then calculate timestamp of each ping
+        """
+        table = self.ping_table
+        second = table['second']
+        # Runs of pings with equal second
+        run_starts = np.flatnonzero(np.concatenate(([True], second[1:] != second[:-1])))
+        run_lengths = np.diff(np.append(run_starts, len(second)))
+        pos_in_run = np.arange(len(second)) - np.repeat(run_starts, run_lengths)
+        table['hseconds'] = (pos_in_run * (100 / np.repeat(run_lengths, run_lengths))).astype(int)
+
+        # Pings after midnight rollover without change of date are on the next day
+        table['time'] = ut.timeToEpoch(table['year'],
+                                       table['month'] + 1, # Month in XTF starts from 0
+                                       table['day'],
+                                       table['hour'],
+                                       table['minute'],
+                                       table['second'],
+                                       table['hseconds']) + self.reader.day_offsets * 86400.0
+
+
+    def _buildTimeIndex(self):
+        """
+        Monotonic ping times for binary search of pings by time.
+        Days of midnight rollovers are already added to ping times (see XTFReader)
+        """
+        self.time_index = np.maximum.accumulate(self.ping_table['time'])
+        self._rollover_days = int(self.reader.day_offsets.max(initial=0))
 
-    def __init__(self, xtf_file):
-        (file_header, packets) = pyxtf.xtf_read(xtf_file)
-        self.file_header = file_header
-        self.sonar_packets = packets[pyxtf.XTFHeaderType.sonar]
-        self.left_chan_width = self.sonar_packets[0].data[0].shape[0]
-        self.right_chan_width = self.sonar_packets[0].data[1].shape[0]
-        self.pings_num = len(self.sonar_packets)
-        self.video_files_list = []
 
-        # self.left_chan_ranges = [self.sonar_packets[i].ping_chan_headers[0].SlantRange for i in range(self.pings_num)]
-        # self.right_chan_ranges = [self.sonar_packets[i].ping_chan_headers[1].SlantRange for i in range(self.pings_num)]
+    def _unwrapQueryTimes(self, input_sec):
+        """
+        Query times with date not changed at midnight, as in pings after rollover,
+        are moved to the day after the first ping if only there they fall inside the file
+        """
+        if self._rollover_days == 0:
+            return input_sec
+        days = np.clip(np.ceil((self.time_index[0] - input_sec) / 86400), 0, self._rollover_days)
+        unwrapped = input_sec + days * 86400
+        return np.where(unwrapped <= self.time_index[-1], unwrapped, input_sec)
+    
 
 
-        # Update HSeconds parameter (hundredths of second) (because it's always zero in our Videomodule XTF files)
-        count = 1
-        i0 = 0
-        for i in range(1, len(self.sonar_packets)):
-            if self.sonar_packets[i].Second == self.sonar_packets[i-1].Second:
-                count += 1
-            else:
-                # Update parameter in counted group
-                for j in range(i0, i0 + count):
-                    self.sonar_packets[j].HSeconds = int((j - i0)*(100/count))
-                count = 1
-                i0 = i
+    def __init__(self, xtf_file, index_file=None, workers=1, channels=DEFAULT_CHANNELS,
+                 time_window=None, ping_range=None):
+        """
+        index_file is sidecar index of XTF packets, created if it doesn't exist (see XTFReader).
+        workers is number of processes to decode waterfall of large file (0 for all CPU cores).
+        channels are numbers of port and starboard channels in ping, other channels are not read.
+        time_window (start, end) in seconds of day and ping_range (start, stop) choose part of file,
+        only these pings are read and processed
+        """
+        # Pings are sorted by time as pyxtf.concatenate_channel does
+        self.reader = XTFReader(xtf_file, index_file, channels, time_window, ping_range)
+        self.file_header = self.reader.file_header
+        self.left_chan_width = int(self.reader.num_samples[0, 0])
+        self.right_chan_width = int(self.reader.num_samples[0, 1])
+        self.pings_num = self.reader.pings_num
+        self.workers = workers
+        self._written_lines = {}
+        self.video_files_list = []
+        self.ground_range = None # Set by slant range correction, meters
+        self._fish_heights = None
+        # Image is built on first use of fullImage
+        self._waterfall = None
+        self._histogram = None
+        self._full_image = None
+        self._preserve_alpha = True
+        self.gamma = None
+
+        self.ping_table = self._buildPingTable()
+        self._reconstructTime()
+        self._buildTimeIndex()
 
         # Calculate pings per sec
-        t0 = self.getPingTime(0)
-        t1 = self.getPingTime(self.pings_num-1)
-        t0 = ut.timeToSec(*t0)
-        t1 = ut.timeToSec(*t1)
+        t0 = self.ping_table['time'][0]
+        t1 = self.ping_table['time'][-1]
         self.pings_per_sec = self.pings_num/(t1-t0)
 
-        self.generateFullImage()
-
 
 if __name__ == '__main__':
     xtf_files = glob.glob('test/*.xtf')
@@ -0,0 +1,83 @@
+"""
+Module with on-disk cache of intermediate results of mosaic pipeline.
+Every stage result is .npz file in proc/cache named by stage and key,
+key is hash of stage inputs and settings it depends on.
+Least recently used files are removed when cache grows over its size limit.
+"""
+
+import os
+import glob
+import logging
+import numpy as np
+from lib.io import FileNaming, saveNpz
+
+CACHE_FOLDER = 'cache'
+
+
+class StageCache:
+
+    def __init__(self, directory, max_bytes):
+        """
+        max_bytes is size limit of cache folder, 0 disables cache
+        """
+        self.folder = os.path.join(directory, FileNaming.proc_name, CACHE_FOLDER)
+        self.max_bytes = max_bytes
+
+
+    def _fileName(self, stage, key):
+        return os.path.join(self.folder, f'{stage}_{key}.npz')
+
+
+    def load(self, stage, key):
+        """
+        Dictionary of arrays saved for stage and key, None if there are no such results
+        """
+        if self.max_bytes <= 0:
+            return None
+        file_name = self._fileName(stage, key)
+        try:
+            with np.load(file_name) as cached:
+                arrays = {name: cached[name] for name in cached.files}
+        except (OSError, ValueError):
+            return None
+        # Modification time is last use time for eviction
+        os.utime(file_name)
+        return arrays
+
+
+    def save(self, stage, key, **arrays):
+        if self.max_bytes <= 0:
+            return
+        file_name = self._fileName(stage, key)
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            saveNpz(file_name, **arrays)
+        except OSError as e:
+            logging.warning(f'Stage {stage} is not cached: {e}')
+            return
+        self.evict(keep=file_name)
+
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used files until cache fits into its size limit.
+        keep is file that is not removed, e.g. just saved
+        """
+        files = []
+        for file_name in glob.glob(os.path.join(glob.escape(self.folder), '*.npz')):
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file_name))
+        total = sum(size for _, size, _ in files)
+        for _, size, file_name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and os.path.abspath(file_name) == os.path.abspath(keep):
+                continue
+            try:
+                os.remove(file_name)
+                total -= size
+            except OSError:
+                pass
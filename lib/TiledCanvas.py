@@ -0,0 +1,196 @@
+"""
+Module with sparse tiled canvas for mosaics.
+Canvas is split into square tiles, a tile is allocated when a stripe is placed on it,
+so memory depends on area covered by sonar data, not on bounding box of track.
+Disk canvas keeps only recently used tiles in memory and the rest in tile folder.
+"""
+
+import os
+import shutil
+from collections import OrderedDict
+import numpy as np
+
+TILE_SIZE = 1024
+
+
+class TiledCanvas:
+
+    def __init__(self, height, width, tile_size=TILE_SIZE):
+        """
+        Canvas of grayscale image and alpha
+        """
+        self.shape = (height, width)
+        self.tile_size = tile_size
+        # (tile row, tile column): (image, alpha)
+        self.tiles = {}
+
+
+    def _newTile(self, key):
+        """
+        White image and transparent alpha of tile, tiles on the right and bottom edges are cut by canvas
+        """
+        top, left = self.tileOrigin(key)
+        height = min(self.tile_size, self.shape[0] - top)
+        width = min(self.tile_size, self.shape[1] - left)
+        image = np.full((height, width), 255, dtype=np.uint8)
+        alpha = np.zeros((height, width), dtype=np.uint8)
+        return image, alpha
+
+
+    def tileOrigin(self, key):
+        """
+        Row and column of top left pixel of tile on canvas
+        """
+        return key[0] * self.tile_size, key[1] * self.tile_size
+
+
+    def getTile(self, key):
+        """
+        Image and alpha of tile, tile is allocated on first use
+        """
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self._newTile(key)
+            self.tiles[key] = tile
+        return tile
+
+
+    def regions(self, top, left, height, width):
+        """
+        Parts of rectangle on canvas split by tiles: key of tile, slices of part in tile
+        and slices of part in rectangle. Parts outside of canvas are skipped
+        """
+        bottom = min(top + height, self.shape[0])
+        right = min(left + width, self.shape[1])
+        row_start = max(top, 0)
+        col_start = max(left, 0)
+        size = self.tile_size
+        if bottom <= row_start or right <= col_start:
+            return
+        for tile_row in range(row_start // size, (bottom - 1) // size + 1):
+            y0 = max(row_start, tile_row * size)
+            y1 = min(bottom, (tile_row + 1) * size)
+            for tile_col in range(col_start // size, (right - 1) // size + 1):
+                x0 = max(col_start, tile_col * size)
+                x1 = min(right, (tile_col + 1) * size)
+                yield ((tile_row, tile_col),
+                       (slice(y0 - tile_row * size, y1 - tile_row * size),
+                        slice(x0 - tile_col * size, x1 - tile_col * size)),
+                       (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left)))
+
+
+    def iterTiles(self):
+        """
+        Allocated tiles by rows: row and column of top left pixel on canvas, image, alpha
+        """
+        for key in sorted(self.tiles):
+            top, left = self.tileOrigin(key)
+            image, alpha = self.tiles[key]
+            yield top, left, image, alpha
+
+
+    def toArrays(self):
+        """
+        Dense image and alpha of the whole canvas, for small canvases only
+        """
+        image = np.full(self.shape, 255, dtype=np.uint8)
+        alpha = np.zeros(self.shape, dtype=np.uint8)
+        for top, left, tile_image, tile_alpha in self.iterTiles():
+            height, width = tile_alpha.shape
+            image[top : top + height, left : left + width] = tile_image
+            alpha[top : top + height, left : left + width] = tile_alpha
+        return image, alpha
+
+
+    def memoryBytes(self):
+        return sum(image.nbytes + alpha.nbytes for image, alpha in self.tiles.values())
+
+
+class DiskTiledCanvas(TiledCanvas):
+    """
+    Tiled canvas with tiles stored in folder on disk. Recently used tiles are kept in memory
+    up to max_bytes, least recently used are written to disk as rasterization moves along the track,
+    so size of canvas is limited by disk only
+    """
+
+    def __init__(self, height, width, folder, max_bytes, tile_size=TILE_SIZE):
+        super().__init__(height, width, tile_size)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        # Tiles in memory, least recently used first
+        self.tiles = OrderedDict()
+        # Keys of tiles written to disk
+        self.stored = set()
+        self._memory = 0
+        # Tiles of interrupted run are not used
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+
+
+    def _tileName(self, key):
+        return os.path.join(self.folder, f'{key[0]}_{key[1]}.npy')
+
+
+    def _saveTile(self, key, image, alpha):
+        with open(self._tileName(key), 'wb') as f_write:
+            np.save(f_write, image)
+            np.save(f_write, alpha)
+        self.stored.add(key)
+
+
+    def _loadTile(self, key):
+        with open(self._tileName(key), 'rb') as f_read:
+            image = np.load(f_read)
+            alpha = np.load(f_read)
+        return image, alpha
+
+
+    def getTile(self, key):
+        """
+        Image and alpha of tile to change, tile is allocated or read from disk if it's not in memory.
+        Other tiles may be moved to disk, so they must not be changed after this call
+        """
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+        tile = self._loadTile(key) if key in self.stored else self._newTile(key)
+        self.tiles[key] = tile
+        self._memory += tile[0].nbytes + tile[1].nbytes
+        self._evict()
+        return tile
+
+
+    def _evict(self):
+        """
+        Write least recently used tiles to disk until memory fits into max_bytes, the last tile is kept
+        """
+        while self._memory > self.max_bytes and len(self.tiles) > 1:
+            key, (image, alpha) = self.tiles.popitem(last=False)
+            self._saveTile(key, image, alpha)
+            self._memory -= image.nbytes + alpha.nbytes
+
+
+    def iterTiles(self):
+        """
+        All tiles by rows, tiles on disk are read one by one and not kept in memory
+        """
+        for key in sorted(set(self.tiles) | self.stored):
+            tile = self.tiles.get(key)
+            image, alpha = tile if tile is not None else self._loadTile(key)
+            top, left = self.tileOrigin(key)
+            yield top, left, image, alpha
+
+
+    def memoryBytes(self):
+        return self._memory
+
+
+    def close(self):
+        """
+        Remove tile folder, canvas is empty after it
+        """
+        self.tiles.clear()
+        self.stored.clear()
+        self._memory = 0
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -20,6 +20,20 @@ def timeToSec(year, month, day, hour, minute, second, hseconds):
            hour * 3600 + minute * 60 + \
            second + hseconds / 100
 
+def timeToEpoch(year, month, day, hour, minute, second, hseconds):
+    """
+    Seconds since 1970-01-01 as float64, works elementwise with numpy arrays.
+    Unlike timeToSec takes real length of months and years into account
+    """
+    months = (np.asarray(year, dtype=np.int64) - 1970) * 12 + np.asarray(month, dtype=np.int64) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + \
+           np.asarray(day, dtype=np.int64) - 1
+    return days * 86400.0 + \
+           np.asarray(hour, dtype=np.float64) * 3600 + \
+           np.asarray(minute, dtype=np.float64) * 60 + \
+           np.asarray(second, dtype=np.float64) + \
+           np.asarray(hseconds, dtype=np.float64) / 100
+
 def calcDistance(pt1 : tuple, pt2 : tuple):
     x1, y1 = pt1
     x2, y2 = pt2
@@ -191,6 +205,58 @@ def gammaCorrection(image, gamma):
     return result.astype(np.uint8)
 
 
+def imageRowBlocks(image, block_pixels=1 << 22):
+    """
+    Slices of image rows with about block_pixels pixels in each
+    """
+    rows = max(1, block_pixels // max(1, int(np.prod(image.shape[1:]))))
+    return [slice(start, start + rows) for start in range(0, image.shape[0], rows)]
+
+
+def imageHistogram(image):
+    """
+    Histogram of uint8 or uint16 image, one bin for each level.
+    Counted by blocks of rows to avoid large temporary arrays
+    """
+    hist = np.zeros(np.iinfo(image.dtype).max + 1, dtype=np.int64)
+    for rows in imageRowBlocks(image):
+        hist += np.bincount(image[rows].ravel(), minlength=len(hist))
+    return hist
+
+
+def levelsLut(hist, dtype, preserve_alpha=False, gamma=None):
+    """
+    Lookup table that scales levels from the lowest to the highest non-empty bin of histogram
+    to range from 0 to 1 for float dtype, or to full range of integer dtype.
+    If preserve_alpha, levels are not less than 1/255.
+    Gamma correction is applied if gamma is given
+    """
+    dtype = np.dtype(dtype)
+    levels = np.flatnonzero(hist)
+    low, high = (levels[0], levels[-1]) if len(levels) else (0, 0)
+    lut = np.arange(len(hist), dtype=np.float64) - low
+    if high > low:
+        lut /= high - low
+    np.clip(lut, 0, 1, out=lut)
+    if preserve_alpha:
+        np.maximum(lut, 1/255, out=lut)
+    if gamma is not None:
+        np.power(lut, 1/gamma, out=lut)
+    if dtype.kind != 'f':
+        lut *= np.iinfo(dtype).max
+    return lut.astype(dtype)
+
+
+def applyLut(image, lut):
+    """
+    lut[image] by blocks of rows
+    """
+    output = np.empty(image.shape, dtype=lut.dtype)
+    for rows in imageRowBlocks(image):
+        np.take(lut, image[rows], out=output[rows], mode='clip')
+    return output
+
+
 def normalize(image):
     image = img_as_float(image)
     result = ((image - np.amin(image)) /
@@ -0,0 +1,385 @@
+"""
+Module to read sonar pings of XTF file without decoding every packet.
+File is memory mapped, packet offsets are found by one scan of packet headers,
+ping headers are parsed into numpy structured arrays at once
+and channel samples are numpy views into the file.
+"""
+
+import ctypes
+import logging
+import mmap
+import struct
+import numpy as np
+import pyxtf
+import lib.Utils as ut
+from lib.dtypes import PACKET_INDEX_DTYPE
+from lib.io import fileFingerprint, saveNpz
+from lib.Parallel import SharedArray
+
+# MagicNumber, HeaderType, SubChannelNumber, NumChansToFollow, Reserved1, NumBytesThisRecord
+PACKET_START = struct.Struct('<HBBH4xI')
+MAGIC_NUMBER = 0xFACE
+# Number of headers copied from file at once
+GATHER_CHUNK = 4096
+# Only port and starboard channels are read
+SONAR_CHANNELS = 2
+# Port and starboard of the first frequency
+DEFAULT_CHANNELS = (0, 1)
+# Change when PACKET_INDEX_DTYPE or packet scan changes
+INDEX_VERSION = 1
+# Change when order or times of pings change, so results of pings cached by other modules are rebuilt
+PINGS_VERSION = 2
+# Backward jump of ping time in file order that is midnight rollover without change of date, seconds
+ROLLOVER_JUMP = 43200
+
+PING_HEADER_FIELDS = ['NumChansToFollow', 'NumBytesThisRecord', 'PingNumber',
+                      'Year', 'Month', 'Day', 'Hour', 'Minute', 'Second', 'HSeconds',
+                      'ShipXcoordinate', 'ShipYcoordinate', 'SensorXcoordinate', 'SensorYcoordinate',
+                      'CableOut', 'SensorPrimaryAltitude', 'SensorHeading']
+CHAN_HEADER_FIELDS = ['ChannelNumber', 'SlantRange', 'NumSamples', 'Weight']
+
+
+def structDtype(structure, names):
+    """
+    Numpy dtype with chosen fields of pyxtf ctypes structure at their offsets
+    """
+    field_types = {}
+    for cls in reversed(structure.__mro__):
+        field_types.update(dict(getattr(cls, '_fields_', [])))
+    return np.dtype({'names': names,
+                     'formats': [np.dtype(field_types[name]).newbyteorder('<') for name in names],
+                     'offsets': [getattr(structure, name).offset for name in names],
+                     'itemsize': ctypes.sizeof(structure)})
+
+
+PING_HEADER_DTYPE = structDtype(pyxtf.XTFPingHeader, PING_HEADER_FIELDS)
+CHAN_HEADER_DTYPE = structDtype(pyxtf.XTFPingChanHeader, CHAN_HEADER_FIELDS)
+
+
+def stridedRows(buffer, dtype, offsets, lengths):
+    """
+    Samples at offsets of buffer as 2D read-only view.
+    Possible only if pings have equal number of samples and are equally spaced in file,
+    otherwise returns None
+    """
+    if len(lengths) == 0 or np.any(lengths != lengths[0]):
+        return None
+    steps = np.diff(offsets)
+    if len(steps) and (steps[0] <= 0 or np.any(steps != steps[0])):
+        return None
+    return np.ndarray((len(lengths), lengths[0]), dtype=dtype, buffer=buffer,
+                      offset=int(offsets[0]),
+                      strides=(int(steps[0]) if len(steps) else 0, dtype.itemsize))
+
+
+def decodePingsShared(xtf_file, image_descriptor, first_row, data_offsets, num_samples, sample_dtypes, port_width):
+    """
+    Worker process function: copy samples of pings into rows of shared image starting from first_row.
+    data_offsets and num_samples are (pings, 2) arrays of port and starboard in order of rows.
+    Row is [port | starboard], port is padded at the beginning, starboard at the end
+    """
+    image = SharedArray.attach(image_descriptor)
+    try:
+        with open(xtf_file, 'rb') as f_read:
+            file_map = mmap.mmap(f_read.fileno(), 0, access=mmap.ACCESS_READ)
+        rows = image.array[first_row : first_row + len(data_offsets)]
+        rows[:] = 0
+        for channel, columns in enumerate((slice(None, port_width), slice(port_width, None))):
+            dtype = np.dtype(sample_dtypes[channel])
+            offsets = data_offsets[:, channel]
+            lengths = num_samples[:, channel]
+            out = rows[:, columns]
+            width = out.shape[1]
+            # Pings of equal length, equally spaced in file, are copied at once
+            samples = stridedRows(file_map, dtype, offsets, lengths)
+            if samples is not None:
+                length = samples.shape[1]
+                out[:, width - length if channel == 0 else 0:][:, :length] = samples
+                continue
+            for row, offset, length in zip(out, offsets, lengths):
+                data = np.frombuffer(file_map, dtype=dtype, count=length, offset=offset)
+                row[width - length if channel == 0 else 0:][:length] = data
+    finally:
+        rows = out = samples = data = None
+        image.close()
+
+
+class NoPingsError(ValueError):
+    """
+    File has no sonar pings, or none in chosen part
+    """
+
+
+def rolloverDays(times):
+    """
+    Days to add to ping times (seconds, in file order) after midnight rollovers:
+    some sonars don't change date in XTF at midnight, so time jumps back by about a day
+    """
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(([0], np.cumsum(np.diff(times) < -ROLLOVER_JUMP)))
+
+
+class XTFReader:
+    """
+    Sonar pings of XTF file, sorted by time as pyxtf.concatenate_channel does.
+    Pings after midnight rollover without change of date are sorted as pings of the next day,
+    day_offsets is number of days to add to their header time.
+    ping_headers and chan_headers (port and starboard) are structured arrays,
+    num_samples is number of samples of each channel of each ping,
+    data_offsets is position of its first sample in file.
+    packets is index of all packets (see dtypes.PACKET_INDEX_DTYPE).
+    If index_file is given, index is loaded from it instead of scanning the file,
+    or saved to it after scan.
+    channels are numbers of port and starboard channels in ping,
+    e.g. (2, 3) for second frequency. Samples of other channels are not read.
+    time_window (start, end) in seconds of day and ping_range (start, stop) in sorted pings
+    choose a part of file, None for open end. Headers of other pings are not read
+    if the index is loaded
+    """
+
+    def __init__(self, xtf_file, index_file=None, channels=DEFAULT_CHANNELS, time_window=None, ping_range=None):
+        self.xtf_file = xtf_file
+        self.channels = tuple(int(channel) for channel in channels)
+        with open(xtf_file, 'rb') as f_read:
+            self._mmap = mmap.mmap(f_read.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+        self._fingerprint = None
+
+        self.file_header = pyxtf.XTFFileHeader.create_from_buffer(
+            self._mmap[:ctypes.sizeof(pyxtf.XTFFileHeader)])
+        sonar_info = self.file_header.sonar_info
+        if len(self.channels) != SONAR_CHANNELS or len(set(self.channels)) != SONAR_CHANNELS or \
+           not all(0 <= channel < len(sonar_info) for channel in self.channels):
+            available = ', '.join(f'{i} ({chan_info.Frequency} kHz)' for i, chan_info in enumerate(sonar_info))
+            raise ValueError(f'{xtf_file} has no sonar channels {self.channels}, available: {available}')
+        # Sample types of all channels up to the last chosen one, to step over their samples
+        self._all_sample_dtypes = [self._sampleDtype(chan_info)
+                                   for chan_info in sonar_info[:max(self.channels) + 1]]
+        self.sample_dtypes = [self._all_sample_dtypes[channel] for channel in self.channels]
+
+        self.packets = self._loadIndex(xtf_file, index_file) if index_file is not None else None
+        scanned = self.packets is None
+        if scanned:
+            self.packets = self._scanPackets()
+        sonar = np.flatnonzero((self.packets['header_type'] == pyxtf.XTFHeaderType.sonar.value) &
+                               (self.packets['num_bytes'] >= PING_HEADER_DTYPE.itemsize))
+        if scanned:
+            # Index needs headers of all pings
+            self.ping_headers = self._gatherHeaders(self.packets['offset'][sonar], PING_HEADER_DTYPE)
+            self._indexPings(sonar)
+            if index_file is not None:
+                self._saveIndex(xtf_file, index_file)
+        day_offsets = rolloverDays(self.packets['time'][sonar])
+        selected = np.ones(len(sonar), dtype=bool) if time_window is None else \
+                   self._timeWindowMask(self.packets['time'][sonar] + day_offsets * 86400.0, *time_window)
+        offsets = self.packets['offset'][sonar[selected]]
+        if scanned:
+            self.ping_headers = self.ping_headers[selected]
+        else:
+            self.ping_headers = self._gatherHeaders(offsets, PING_HEADER_DTYPE)
+        valid = self._readChannelHeaders(offsets)
+
+        # Sort by time, stable as in pyxtf, pings after rollover go last
+        day_offsets = day_offsets[selected][valid]
+        order = np.lexsort([self.ping_headers[name] for name in
+                            ('HSeconds', 'Second', 'Minute', 'Hour', 'Day', 'Month', 'Year')] + [day_offsets])
+        if ping_range is not None:
+            order = order[slice(*ping_range)]
+        self.ping_headers = self.ping_headers[order]
+        self.chan_headers = self.chan_headers[order]
+        self.num_samples = self.num_samples[order]
+        self.data_offsets = self.data_offsets[order]
+        self.day_offsets = day_offsets[order]
+        self.pings_num = len(order)
+        if self.pings_num == 0:
+            raise NoPingsError(f'{xtf_file} has no sonar pings' +
+                                ('' if time_window is None and ping_range is None else ' in chosen part'))
+
+
+    @staticmethod
+    def _sampleDtype(chan_info):
+        # Sample format field is used if filled, as in pyxtf
+        if chan_info.SampleFormat in pyxtf.xtf_ctypes.sample_format_dtype:
+            dtype = pyxtf.xtf_ctypes.sample_format_dtype[chan_info.SampleFormat]
+        else:
+            dtype = pyxtf.xtf_ctypes.xtf_dtype[chan_info.BytesPerSample]
+        return np.dtype(dtype).newbyteorder('<')
+
+
+    def _scanPackets(self):
+        """
+        Index of all packets in file order, without time and position.
+        Scan stops at broken or truncated packet
+        """
+        offsets = []
+        packets_bytes = []
+        header_types = []
+        file_size = len(self._mmap)
+        pos = ctypes.sizeof(pyxtf.XTFFileHeader)
+        while pos + PACKET_START.size <= file_size:
+            magic, header_type, _, _, num_bytes = PACKET_START.unpack_from(self._mmap, pos)
+            if magic != MAGIC_NUMBER or num_bytes < PACKET_START.size or pos + num_bytes > file_size:
+                logging.warning(f'Broken XTF packet at byte {pos}, rest of file is skipped')
+                break
+            offsets.append(pos)
+            packets_bytes.append(num_bytes)
+            header_types.append(header_type)
+            pos += num_bytes
+
+        packets = np.zeros(len(offsets), dtype=PACKET_INDEX_DTYPE)
+        packets['offset'] = offsets
+        packets['num_bytes'] = packets_bytes
+        packets['header_type'] = header_types
+        for column in ('time', 'ship_x', 'ship_y'):
+            packets[column] = np.nan
+        return packets
+
+
+    def _indexPings(self, sonar):
+        """
+        Fill ping number, time and position of sonar packets (rows sonar of index)
+        from ping headers
+        """
+        headers = self.ping_headers
+        self.packets['ping_number'][sonar] = headers['PingNumber']
+        self.packets['ship_x'][sonar] = headers['ShipXcoordinate']
+        self.packets['ship_y'][sonar] = headers['ShipYcoordinate']
+        self.packets['time'][sonar] = ut.timeToEpoch(headers['Year'],
+                                                     headers['Month'] + 1, # Month in XTF starts from 0
+                                                     headers['Day'],
+                                                     headers['Hour'],
+                                                     headers['Minute'],
+                                                     headers['Second'],
+                                                     headers['HSeconds'])
+
+
+    @staticmethod
+    def _timeWindowMask(times, start=None, end=None):
+        """
+        Pings with times (seconds since epoch) inside window from start to end (seconds of day).
+        Window is on the day of the first ping, or on the next day if only there it starts
+        inside the file (line after midnight). End before start is on the next day
+        """
+        if len(times) == 0:
+            return np.zeros(0, dtype=bool)
+        first, last = np.nanmin(times), np.nanmax(times)
+        midnight = np.floor(first / 86400) * 86400
+        start_time = end_time = None
+        if start is not None:
+            start_time = midnight + start
+            if start_time < first and start_time + 86400 <= last:
+                start_time += 86400
+        if end is not None:
+            end_time = midnight + end
+            if start_time is not None:
+                end_time += np.ceil(max(start_time - end_time, 0) / 86400) * 86400
+            elif end_time < first:
+                end_time += 86400
+        mask = np.ones(len(times), dtype=bool)
+        if start_time is not None:
+            mask &= times >= start_time
+        if end_time is not None:
+            mask &= times <= end_time
+        return mask
+
+
+    def _getFingerprint(self, xtf_file):
+        if self._fingerprint is None:
+            self._fingerprint = fileFingerprint(xtf_file)
+        return self._fingerprint
+
+
+    def _loadIndex(self, xtf_file, index_file):
+        """
+        Packet index from index_file, None if there is no index for this file
+        """
+        try:
+            with np.load(index_file) as index:
+                if int(index['version']) != INDEX_VERSION or \
+                   str(index['fingerprint']) != self._getFingerprint(xtf_file):
+                    return None
+                return index['packets']
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+    def _saveIndex(self, xtf_file, index_file):
+        try:
+            saveNpz(index_file, packets=self.packets,
+                    fingerprint=np.array(self._getFingerprint(xtf_file)),
+                    version=np.array(INDEX_VERSION))
+        except OSError as e:
+            logging.warning(f'Index file {index_file} is not saved: {e}')
+
+
+    def _gatherHeaders(self, offsets, dtype):
+        """
+        Headers of dtype at offsets, copied from file by chunks
+        """
+        raw = np.empty((len(offsets), dtype.itemsize), dtype=np.uint8)
+        header_bytes = np.arange(dtype.itemsize)
+        for start in range(0, len(offsets), GATHER_CHUNK):
+            chunk = offsets[start : start + GATHER_CHUNK]
+            raw[start : start + len(chunk)] = self._buffer[chunk[:, np.newaxis] + header_bytes]
+        return raw.view(dtype).ravel()
+
+
+    def _readChannelHeaders(self, offsets):
+        """
+        Channel headers, number of samples and data offsets of port and starboard.
+        Headers of channels before the chosen ones are read only to find their size.
+        Pings without room for their samples in the packet are dropped, pyxtf fails on them.
+        Returns mask of pings that are kept
+        """
+        pings_num = len(offsets)
+        self.chan_headers = np.zeros((pings_num, SONAR_CHANNELS), dtype=CHAN_HEADER_DTYPE)
+        self.num_samples = np.zeros((pings_num, SONAR_CHANNELS), dtype=np.int64)
+        self.data_offsets = np.zeros((pings_num, SONAR_CHANNELS), dtype=np.int64)
+        packet_ends = offsets + self.ping_headers['NumBytesThisRecord']
+        valid = self.ping_headers['NumChansToFollow'] > max(self.channels)
+
+        chan_offsets = offsets + PING_HEADER_DTYPE.itemsize
+        for channel, chan_info in enumerate(self.file_header.sonar_info[:len(self._all_sample_dtypes)]):
+            valid &= chan_offsets + CHAN_HEADER_DTYPE.itemsize <= packet_ends
+            chan_offsets = np.where(valid, chan_offsets, offsets)
+            chan_headers = self._gatherHeaders(chan_offsets, CHAN_HEADER_DTYPE)
+            # Old files have number of samples in channel info
+            num_samples = chan_headers['NumSamples'].astype(np.int64)
+            num_samples[num_samples == 0] = chan_info.Reserved
+            data_offsets = chan_offsets + CHAN_HEADER_DTYPE.itemsize
+            chan_offsets = data_offsets + num_samples * self._all_sample_dtypes[channel].itemsize
+            valid &= chan_offsets <= packet_ends
+            if channel in self.channels:
+                side = self.channels.index(channel)
+                self.chan_headers[:, side] = chan_headers
+                self.num_samples[:, side] = num_samples
+                self.data_offsets[:, side] = data_offsets
+
+        if not valid.all():
+            logging.warning(f'{np.count_nonzero(~valid)} broken sonar packets are skipped')
+            self.ping_headers = self.ping_headers[valid]
+            self.chan_headers = self.chan_headers[valid]
+            self.num_samples = self.num_samples[valid]
+            self.data_offsets = self.data_offsets[valid]
+        return valid
+
+
+    def channel(self, ping_no, channel):
+        """
+        Samples of one channel of ping (0 - port, 1 - starboard), read-only view into file
+        """
+        return np.frombuffer(self._mmap, dtype=self.sample_dtypes[channel],
+                             count=self.num_samples[ping_no, channel],
+                             offset=self.data_offsets[ping_no, channel])
+
+
+    def channelRows(self, channel, start, stop):
+        """
+        Samples of one channel for pings from start to stop as 2D read-only view into file.
+        Possible only if pings have equal number of samples and are equally spaced in file,
+        otherwise returns None
+        """
+        return stridedRows(self._mmap, self.sample_dtypes[channel],
+                           self.data_offsets[start:stop, channel],
+                           self.num_samples[start:stop, channel])
@@ -1,3 +1,41 @@
+import numpy as np
+
+# Per-ping header values extracted once from XTF sonar packets.
+# Two-element fields hold port (0) and starboard (1) channel values.
+PING_TABLE_DTYPE = np.dtype([
+    ('year', np.uint16),
+    ('month', np.uint8),    # As stored in XTF (starts from 0)
+    ('day', np.uint8),
+    ('hour', np.uint8),
+    ('minute', np.uint8),
+    ('second', np.uint8),
+    ('hseconds', np.uint8), # Hundredths of second
+    ('time', np.float64),   # Seconds since 1970-01-01, see Utils.timeToEpoch
+    ('ship_x', np.float64),
+    ('ship_y', np.float64),
+    ('sensor_x', np.float64),
+    ('sensor_y', np.float64),
+    ('gk_x', np.float64),
+    ('gk_y', np.float64),
+    ('slant_range', np.float32, (2,)),
+    ('num_samples', np.uint32, (2,)),
+    ('weight', np.int16, (2,)),     # Samples are multiplied by 2 ** -weight
+    ('cable_out', np.uint16),
+    ('altitude', np.float32),
+    ('heading', np.float32)
+])
+
+# Sidecar index of XTF packets in file order (see XTFReader).
+# Time and position are filled for sonar pings only, NaN for other packets
+PACKET_INDEX_DTYPE = np.dtype([
+    ('offset', np.int64),       # Byte offset of packet in file
+    ('num_bytes', np.uint32),
+    ('header_type', np.uint8),
+    ('ping_number', np.uint32),
+    ('time', np.float64),       # Seconds since 1970-01-01, HSeconds as in file
+    ('ship_x', np.float64),
+    ('ship_y', np.float64)
+])
 
 
 class GKpoint(tuple):
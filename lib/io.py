@@ -1,13 +1,31 @@
 import numpy as np
 import os
+import glob
+import hashlib
+import json
+from io import StringIO
+
+# Bytes from the beginning and the end of file used for fingerprint
+FINGERPRINT_BYTES = 1 << 20
+# Change when first reflection search changes, so old bottom files are not used
+BOTTOM_CACHE_VERSION = 3
+# Rows of csv formatted at once
+CSV_CHUNK_ROWS = 100000
+# Formats of track coordinates in csv: degrees to 1e-9 (0.1 mm) and meters to 1 mm
+WGS_CSV_FORMAT = '%.9f'
+PLANE_CSV_FORMAT = '%.3f'
 
 class FileNaming:
 
     proc_name = 'proc'
     out_name = 'mosaic'
 
-    def __init__(self, xtf_file):
+    def __init__(self, xtf_file, subset_name=''):
+        """
+        subset_name is added to names of output files of a part of XTF file
+        """
         self.xtf_file_name = xtf_file
+        self.subset_name = subset_name
         path, fname = os.path.split(xtf_file)
         self.base_path = path
         self.base_name = fname
@@ -15,6 +33,7 @@ class FileNaming:
         # add folders
         self.proc_folder = os.path.join(self.base_path, 'proc')
         self.output_folder = os.path.join(self.base_path, 'mosaic')
+        self._fingerprint = None
 
         self.createFolders()
 
@@ -22,28 +41,68 @@ class FileNaming:
         return self.xtf_file_name
     
     def get_track_WGS_name(self):
-        outputfile =  '.'.join(self.base_name.split('.')[:-1]) + '.csv'
+        outputfile =  self._output_stem() + '.csv'
         return os.path.join(self.proc_folder, outputfile)
     
-    def get_bottom_file_name(self):
-        outputfile =  '.'.join(self.base_name.split('.')[:-1]) + '_Bottom_data.csv'
+    def get_fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = fileFingerprint(self.xtf_file_name)
+        return self._fingerprint
+
+    def get_bottom_file_name(self, startrefl, window_size, frst_refl_bias, channels=(0, 1)):
+        """
+        Binary file with first reflections, name depends on XTF content,
+        sonar channels and parameters of first reflection search
+        """
+        key = cacheKey(self.get_fingerprint(), BOTTOM_CACHE_VERSION, startrefl, window_size, frst_refl_bias,
+                       *channels)
+        outputfile =  self._output_stem() + f'_Bottom_{key}.npy'
         return os.path.join(self.proc_folder, outputfile)
+
+    def remove_stale_bottom_files(self, bottom_file):
+        """
+        Remove bottom files of this XTF, except bottom_file
+        """
+        pattern = glob.escape(self._output_stem()) + '_Bottom_*.npy'
+        for stale_file in glob.glob(os.path.join(glob.escape(self.proc_folder), pattern)):
+            if os.path.abspath(stale_file) != os.path.abspath(bottom_file):
+                os.remove(stale_file)
     
+    def _output_stem(self):
+        return '.'.join(self.base_name.split('.')[:-1]) + self.subset_name
+
+    def get_index_name(self):
+        outputfile =  '.'.join(self.base_name.split('.')[:-1]) + '_index.npz'
+        return os.path.join(self.proc_folder, outputfile)
+
     def get_track_GK_name(self):
-        outputfile =  '.'.join(self.base_name.split('.')[:-1]) + '-GK.csv'
+        outputfile =  self._output_stem() + '-GK.csv'
         return os.path.join(self.proc_folder, outputfile)
     
+    def get_track_name(self):
+        """
+        Binary track of XTF file: ping times, WGS84 and projected coordinates (see saveTrack)
+        """
+        outputfile =  self._output_stem() + '_track.npz'
+        return os.path.join(self.proc_folder, outputfile)
+
     def get_track_georef_name(self):
         return self.get_track_WGS_name() + '.gsr2'
     
     def get_map_name(self):
-        outputfile =  '.'.join(self.base_name.split('.')[:-1]) + '_mosaic.png'
+        outputfile =  self._output_stem() + '_mosaic.png'
         return os.path.join(self.output_folder, outputfile)
     
     def get_geotiff_name(self):
-        outputfile =  '.'.join(self.base_name.split('.')[:-1]) + '_mosaic.tif'
+        outputfile =  self._output_stem() + '_mosaic.tif'
         return os.path.join(self.output_folder, outputfile)
     
+    def get_tiles_folder(self):
+        """
+        Folder of mosaic tiles kept on disk while mosaic is built
+        """
+        return os.path.join(self.output_folder, self._output_stem() + '_tiles')
+
     def get_map_georef_name(self):
         return self.get_map_name() + '.georef'
     
@@ -56,49 +115,117 @@ class FileNaming:
     
 
 
-def npToCsv(out_name : str, array : np.ndarray):
+def fileFingerprint(file_name):
+    """
+    Hash of file size and its first and last FINGERPRINT_BYTES.
+    Doesn't depend on file name and modification time, so copied files keep their results
+    """
+    size = os.path.getsize(file_name)
+    digest = hashlib.sha1(str(size).encode())
+    with open(file_name, 'rb') as f_read:
+        digest.update(f_read.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            f_read.seek(max(size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+            digest.update(f_read.read())
+    return digest.hexdigest()
+
+
+def cacheKey(*parts):
+    """
+    Short hash of values to use in file names
+    """
+    return hashlib.sha1(';'.join(str(x) for x in parts).encode()).hexdigest()[:16]
+
+
+def saveNpy(out_name : str, array : np.ndarray):
+    """
+    Write np array to .npy file. File is written under temporary name and renamed,
+    so interrupted run doesn't leave broken file
+    """
+    tmp_name = out_name + '.tmp'
+    with open(tmp_name, 'wb') as f_write:
+        np.save(f_write, array)
+    os.replace(tmp_name, out_name)
+
+
+def saveNpz(out_name : str, **arrays):
+    """
+    Write np arrays to .npz file, under temporary name and renamed as in saveNpy
+    """
+    tmp_name = out_name + '.tmp'
+    with open(tmp_name, 'wb') as f_write:
+        np.savez(f_write, **arrays)
+    os.replace(tmp_name, out_name)
+
+
+def saveJson(out_name : str, data):
     """
-    Write np array to csv
+    Write data to .json file, under temporary name and renamed as in saveNpy
+    """
+    tmp_name = out_name + '.tmp'
+    with open(tmp_name, 'w') as f_write:
+        json.dump(data, f_write, indent=1)
+    os.replace(tmp_name, out_name)
+
+
+def saveTrack(out_name : str, times : np.ndarray, track_wgs : np.ndarray, track_xy : np.ndarray,
+              crs : str, source_key : str = ''):
+    """
+    Write track of XTF file to .npz: ping times (epoch seconds), WGS84 longitude and latitude,
+    projected x, y and their coordinate system. source_key is key of XTF pings the track is made of
+    """
+    saveNpz(out_name,
+            time=np.asarray(times, dtype=np.float64),
+            wgs84=np.asarray(track_wgs, dtype=np.float64).reshape(-1, 2),
+            xy=np.asarray(track_xy, dtype=np.float64).reshape(-1, 2),
+            crs=np.array(crs),
+            source_key=np.array(source_key))
+
+
+def loadTrack(in_name : str) -> dict:
+    """
+    Track written by saveTrack as dictionary of arrays, crs and source_key are str
+    """
+    with np.load(in_name) as track:
+        arrays = {name: track[name] for name in track.files}
+    arrays['crs'] = str(arrays['crs'])
+    arrays['source_key'] = str(arrays['source_key'])
+    return arrays
+
+
+def npToCsv(out_name : str, array : np.ndarray, fmt='%s'):
+    """
+    Write np array to csv. fmt is format of one value, '%s' writes numbers as str() does,
+    fixed formats like '%.3f' are written faster
     """
     if len(array.shape) != 2:
         print('Dimensions must be 2')
+    line_format = ';'.join([fmt] * array.shape[1]) + '\n'
     with open(out_name, 'w') as f_write:
-        for i in range(array.shape[0]):
-            line_list = [str(array[i,j]) for j in range(array.shape[1])]
-            f_write.write(';'.join(line_list) + '\n')
+        # Rows are formatted in chunks by one % operation instead of loop over rows
+        for start in range(0, array.shape[0], CSV_CHUNK_ROWS):
+            chunk = array[start:start + CSV_CHUNK_ROWS]
+            f_write.write((line_format * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
     print(f'{out_name} write successfully')
 
 
+def _loadCsvPairs(in_name : str, delimeter : str, decimal_comma : bool) -> np.ndarray:
+    with open(in_name, 'r') as f_read:
+        text = f_read.read()
+    if decimal_comma:
+        # Replace , with .
+        text = text.replace(',', '.')
+    return np.loadtxt(StringIO(text), delimiter=delimeter, ndmin=2, dtype=np.float64)
+
+
 def loadCsvGK(in_name : str, delimeter=';') -> np.ndarray:
     """
     Loading Csv for pair of coordinates in Gauss Kruger
     """
-    x = []
-    y = []
-    with open(in_name, 'r') as f_read:
-        for line in f_read:
-            line = line.strip()
-            # Replace , with .
-            line = '.'.join(line.split(','))
-            in_x, in_y = line.split(delimeter)
-            x.append(float(in_x))
-            y.append(float(in_y))
-
-    return np.array([x,y]).transpose()
+    return _loadCsvPairs(in_name, delimeter, True)
 
 def loadCsvWGS(in_name : str, delimeter=';') -> np.ndarray:
     """
-    Loading Csv for pair of coordinates in Gauss Kruger
+    Loading Csv for pair of coordinates in WGS84
     """
-    x = []
-    y = []
-    with open(in_name, 'r') as f_read:
-        for line in f_read:
-            line = line.strip()
-            in_x, in_y = line.split(delimeter)
-            x.append(float(in_x))
-            y.append(float(in_y))
-
-    return np.array([x,y]).transpose()
-
-
+    return _loadCsvPairs(in_name, delimeter, False)
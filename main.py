@@ -2,11 +2,12 @@ from lib.Settings import Settings
 from lib.SonarData import SonarData
 from lib.Georef import Georef
 from lib.io import FileNaming
-from lib.GausKruger import GausKruger
+from lib.Projection import Projection
 from tkinter.filedialog import askdirectory
 from lib.MapDrawer import MapDrawer, SonarImageGK
+from lib.LineRenderer import LineRenderer
 from lib.PictureViewer import PictureViewer
-from lib.io import loadCsvGK, npToCsv
+from lib.io import npToCsv, saveTrack, WGS_CSV_FORMAT, PLANE_CSV_FORMAT
 from lib.TrackProcess import TrackProcess
 import numpy as np
 import glob
@@ -16,6 +17,8 @@ from skimage import io
 from matplotlib import pyplot as plt
 import rasterio
 from rasterio.transform import from_origin
+from rasterio.windows import Window
+from rasterio.enums import ColorInterp
 import gc
 
 
@@ -50,48 +53,40 @@ if __name__ == '__main__':
     print(xtf_list)
 
     # Process data
+    times_list = []
+    tracks = []
     for xtf_file in xtf_list:
         naming = FileNaming(xtf_file)
-        # track_file = '.'.join(xtf_file.split('.')[:-1]) + '.csv'
-        # georef = track_file + '.gsr2'
-        track_file = naming.get_track_WGS_name()
-        track_GK_file = naming.get_track_GK_name()
-        georef = naming.get_track_georef_name()
-
-        sonar_data = SonarData(xtf_file)
-        track = sonar_data.extractTrackWGS84()
-        with open(track_file, 'w') as wfile:
-            for line in track:
-                wfile.write(f'{line[0]};{line[1]}\n')
-        print(f'Writing file {track_file} done')
-        gr = Georef()
-        gr.makeSurferGeorefWGS84(georef)
-
-        # Gauss Kruger
-        GK = GausKruger()
-        with open(track_GK_file, 'w') as wfile:
-            lon = track[:,0]
-            lat = track[:,1]
-            GK_X, GK_Y, GK_zone = GK.transform_to_gauss_kruger(lat, lon)
-            for x, y in zip(GK_X, GK_Y):
-                wfile.write(f'{x};{y}\n')
-        print(f'Writing file {track_file} done')
-
+        sonar_data = SonarData(xtf_file, naming.get_index_name(), channels=settings.channels)
+        times_list.append(sonar_data.extractPingTimes())
+        tracks.append(sonar_data.extractTrackWGS84())
         del sonar_data
         gc.collect()
 
+    # All tracks in one projection, so mosaics can be merged.
+    # Tracks are kept in memory for mosaics and saved to binary track files
+    projection = Projection.forSurvey(settings.projection, tracks)
+    print(f'Tracks are projected to {projection}')
+    tracks_xy = projection.projectTracks(tracks)
+    for xtf_file, times, track, track_xy in zip(xtf_list, times_list, tracks, tracks_xy):
+        naming = FileNaming(xtf_file)
+        track_file = naming.get_track_name()
+        saveTrack(track_file, times, track, track_xy, projection.crs)
+        print(f'Writing file {track_file} done')
+        if settings.export_csv:
+            npToCsv(naming.get_track_WGS_name(), track, WGS_CSV_FORMAT)
+            Georef().makeSurferGeorefWGS84(naming.get_track_georef_name())
+            npToCsv(naming.get_track_GK_name(), track_xy, PLANE_CSV_FORMAT)
+
 # Generate maps
-    for xtf_file in xtf_list:
+    for xtf_file, track_input in zip(xtf_list, tracks_xy):
         naming = FileNaming(xtf_file)
-        track_GK_file = naming.get_track_GK_name()
         map_file = naming.get_map_name()
         geotiff_file = naming.get_geotiff_name()
         map_georef_file = naming.get_map_georef_name()
 
         try:
-
-            track_input = loadCsvGK(track_GK_file)
-            sonar = SonarData(xtf_file)
+            sonar = SonarData(xtf_file, naming.get_index_name(), channels=settings.channels)
         except FileNotFoundError:
             print('Missed files')
             exit(1)
@@ -125,25 +120,33 @@ if __name__ == '__main__':
         rotations = track_proc.getTrackRotations()
         print(f'Stripes are {len(sonar_stripes)}, rotations are {len(rotations)}')
 
-        # CALCULATE MARGINS
-        print('Processing track')
-        TL_coordsGK = []
-        BR_coordsGK = []
-        # stripe_imgs = []
-
-        for stripe, rot, trackpoint in zip(sonar_stripes, rotations, offseted_track):
-            stripe_img = SonarImageGK(stripe, TARGET_SCALE, STRIPE_SCALE)
-            stripe_img.updateCenterGK(trackpoint)
-            stripe_img.rotate(rot)
-            TL_coordsGK.append(stripe_img.getGKcoordTopLeft())
-            BR_coordsGK.append(stripe_img.getGKcoordBotRight())
-            # stripe_imgs.append(stripe_img)
-            # del stripe_img
-            # gc.collect()
-
-        print('Estimating map limits')
-        TL_np = np.array(TL_coordsGK)
-        BR_np = np.array(BR_coordsGK)
+        if settings.renderer == 'inverse':
+            # Every pixel of map is sampled from the nearest ping, footprints of stripes are not needed
+            renderer = LineRenderer(sonar.fullImage, sonar.getStripePings()[0],
+                                    offseted_track, rotations, sonar.getSwathWidths())
+            top_left, bottom_right = renderer.getCornersGK()
+            TL_np = np.array([top_left])
+            BR_np = np.array([bottom_right])
+        else:
+            # CALCULATE MARGINS
+            print('Processing track')
+            TL_coordsGK = []
+            BR_coordsGK = []
+            # stripe_imgs = []
+
+            for stripe, rot, trackpoint in zip(sonar_stripes, rotations, offseted_track):
+                stripe_img = SonarImageGK(stripe, TARGET_SCALE, STRIPE_SCALE)
+                stripe_img.updateCenterGK(trackpoint)
+                stripe_img.rotate(rot)
+                TL_coordsGK.append(stripe_img.getGKcoordTopLeft())
+                BR_coordsGK.append(stripe_img.getGKcoordBotRight())
+                # stripe_imgs.append(stripe_img)
+                # del stripe_img
+                # gc.collect()
+
+            print('Estimating map limits')
+            TL_np = np.array(TL_coordsGK)
+            BR_np = np.array(BR_coordsGK)
 
         Map_topY = np.max(TL_np[:,1]) + MARGIN
         Map_leftX = np.min(TL_np[:,0]) - MARGIN
@@ -152,18 +155,23 @@ if __name__ == '__main__':
 
         print(f"TL corner: {Map_leftX}, {Map_topY}, BR corner: {Map_rgtX}, {Map_botY}")
 
-        mapGK = MapDrawer(TARGET_SCALE)
+        mapGK = MapDrawer(TARGET_SCALE, settings.canvas,
+                       naming.get_tiles_folder(), settings.tile_memory * 2**20,
+                       settings.colormap)
         mapGK.createCanvas((Map_leftX, Map_topY), (Map_rgtX, Map_botY))
 
-        for stripe, rot, trackpoint in zip(sonar_stripes, rotations, offseted_track):
-            stripe_img = SonarImageGK(stripe, TARGET_SCALE, STRIPE_SCALE)
-            stripe_img.updateCenterGK(trackpoint)
-            stripe_img.rotate(rot)
-            mapGK.placeStripeOnCanvas(stripe_img)
-            # del stripe_img
-            # gc.collect()
-
-        viewer = PictureViewer('Map', mapGK.getImage())
+        if settings.renderer == 'inverse':
+            mapGK.placeLineOnCanvas(renderer)
+        else:
+            for stripe, rot, trackpoint in zip(sonar_stripes, rotations, offseted_track):
+                stripe_img = SonarImageGK(stripe, TARGET_SCALE, STRIPE_SCALE)
+                stripe_img.updateCenterGK(trackpoint)
+                stripe_img.rotate(rot)
+                mapGK.placeStripeOnCanvas(stripe_img)
+                # del stripe_img
+                # gc.collect()
+
+        viewer = PictureViewer('Map', mapGK.getPreview())
         viewer.show(10)
 
 
@@ -179,31 +187,33 @@ if __name__ == '__main__':
 
         # Calculate the transform (affine transformation matrix)
         transform = from_origin(left, top, (right - left) / width, (top - bottom) / height)
-        image0 = mapGK.getTransparent()
-        # mapGK.deleteCanvas()
-        # MOVE CHANNEL AXES (RGB) to the beginning
-        image = np.moveaxis(image0.squeeze(),-1,0)
-
-        # Write the GeoTIFF file
+        # Write the GeoTIFF file by parts, tiled canvas gives only tiles under stripes,
+        # the rest of map stays transparent
         with rasterio.open(
             geotiff_file,
             'w',
             driver='GTiff',
             height=height,
             width=width,
-            count=4,  # Number of bands
-            dtype=image.dtype,
-            crs=f'EPSG:{28400 + GK_zone}',  # Pulkovo 1942 coordinate system (example, adjust as needed)
+            count=mapGK.getBandsCount(),  # Gray or RGB and alpha
+            dtype=np.uint8,
+            crs=projection.crs,  # The same for all files of survey
             transform=transform
         ) as dst:
             print(type(dst))
-            dst.write(image)  # Write the image data to the first band
+            color_bands = [ColorInterp.gray] if mapGK.getBandsCount() == 2 else \
+                          [ColorInterp.red, ColorInterp.green, ColorInterp.blue]
+            dst.colorinterp = color_bands + [ColorInterp.alpha]
+            for row, col, image in mapGK.getTransparentTiles():
+                # MOVE CHANNEL AXES (bands) to the beginning
+                dst.write(np.moveaxis(image, -1, 0), window=Window(col, row, image.shape[1], image.shape[0]))
 
         print(f"GeoTIFF file saved as {geotiff_file}")
+        # Tiles of disk canvas are removed
+        mapGK.deleteCanvas()
 
         # Clear
         del sonar
-        del image
         del sonar_stripes
         del mapGK
         # del stripe_imgs
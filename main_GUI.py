@@ -1,10 +1,12 @@
 import sys
+import multiprocessing
 from PySide6.QtWidgets import QApplication
 from PySide6.QtCore import QThread
 
 from lib.GUI import MosaicGUI
 from lib.RastrWorker import RastrWorker
 from lib.MosaicWorker import MosaicWorker
+from lib.CatalogWorker import CatalogWorker
 from lib.Settings import Settings
 
 import os
@@ -28,9 +30,10 @@ class AppController:
         self.thread = None
         self.worker = None
         self.rastr_worker = None
+        self.catalog_worker = None
         self.current_folder = None
 
-        self._cur_worker = 0 # 1 for  main, 2 for rastr
+        self._cur_worker = 0 # 1 for  main, 2 for rastr, 3 for catalog
 
         self.settings = Settings()
 
@@ -38,6 +41,7 @@ class AppController:
         self.gui.start_btn.clicked.connect(self.start_processing)
         self.gui.cancel_btn.clicked.connect(self.cancel_processing)
         self.gui.convert_btn.clicked.connect(self.start_rastr2xtf)
+        self.gui.catalog_btn.clicked.connect(self.start_catalog)
 
         self.gui.load_settings(self.settings.as_dict())
         self.gui.show()
@@ -77,6 +81,26 @@ class AppController:
         self.thread.start()
 
 
+    def start_catalog(self):
+        self._cur_worker = 3
+        self.gui.set_running(True)
+        self.gui.set_status("Scanning XTF headers...")
+
+        self.thread = QThread()
+        self.catalog_worker = CatalogWorker(self.settings)
+        self.catalog_worker.moveToThread(self.thread)
+
+        # ---- CONNECT SIGNALS ----
+        self.thread.started.connect(self.catalog_worker.process)
+
+        self.catalog_worker.status.connect(self.gui.set_status)
+
+        self.catalog_worker.finished.connect(self.cleanup_thread)
+        self.catalog_worker.cancelled.connect(self.cleanup_thread)
+
+        self.thread.start()
+
+
     def start_processing(self):
         # if not self.current_folder:
         #     self.gui.set_status("No folder selected", error=True)
@@ -101,9 +125,12 @@ class AppController:
         self.thread.start()
 
     def cancel_processing(self):
-        if self.worker:
+        # Only the running worker is aborted, others may be already deleted
+        workers = {1: self.worker, 2: self.rastr_worker, 3: self.catalog_worker}
+        worker = workers.get(self._cur_worker)
+        if worker:
             self.gui.set_status("Cancelling...")
-            self.worker.abort()
+            worker.abort()
             # self.cleanup_thread()
 
     # ================= CLEANUP =================
@@ -117,6 +144,8 @@ class AppController:
             self.worker.deleteLater()
         elif self._cur_worker == 2:
             self.rastr_worker.deleteLater()
+        elif self._cur_worker == 3:
+            self.catalog_worker.deleteLater()
         self.thread.deleteLater()
         self._cur_worker = 0
 
@@ -124,4 +153,6 @@ class AppController:
 
 
 if __name__ == "__main__":
+    # Needed for process pool in pyinstaller build
+    multiprocessing.freeze_support()
     AppController()